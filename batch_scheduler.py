@@ -0,0 +1,237 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from gpt_arc import select_next_token, prefill
+
+# Continuous batching for GPTModel.
+#
+# Requests are queued and merged into the running decode batch at the next step instead of
+# waiting for the whole batch to finish: a new request is prefilled on its own, and its KV cache
+# is left-padded to the running batch's length and concatenated to it. Rows that produce EOS or
+# reach their token budget are dropped from the cache straight away. Leading columns that are
+# padding in every remaining row are trimmed, so the cache never grows beyond the longest live
+# sequence. The model runs in a single worker thread, which keeps the event loop free to accept
+# requests while a step is computed. With a PrefixKVCache, admitted prompts load their shared
+# prefix (the instruction preamble) from it instead of prefilling it again.
+
+
+class ScheduledRequest:
+    def __init__(self, prompt, max_new_tokens):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.enqueued_at = time.monotonic()
+        self.num_generated = 0  # Only touched by the model thread
+        self.tokens = []
+        self.updates = asyncio.Queue()  # Every new token id, then None once the request is over
+        self.done = asyncio.get_running_loop().create_future()  # Resolves to self.tokens
+        self.cancelled = False
+
+    def finish(self, exception=None):
+        self.updates.put_nowait(None)
+        if not self.done.done():
+            if exception is None:
+                self.done.set_result(self.tokens)
+            else:
+                self.done.set_exception(exception)
+
+
+class ContinuousBatchScheduler:
+    def __init__(self, model, context_size, max_batch_size=16, max_queue_size=64, queue_timeout=30.0,
+                 max_new_tokens=50, temperature=0.0, top_k=None, eos_id=50256, pad_id=50256, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.context_size = context_size
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout  # Max seconds a request may wait before joining the batch
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.eos_id = eos_id
+        self.pad_id = pad_id
+        self.device = next(model.parameters()).device
+
+        self.queue = None
+        self.task = None
+        self.executor = None
+
+        # Running batch, only touched by the model thread: one row per request, in cache order
+        self.rows = []
+        self.pad_lengths = None
+        self.logits = None  # Next-token logits of every row, (len(rows), vocab_size)
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+        error = RuntimeError("Scheduler stopped")
+        for request in self.rows:
+            request.finish(error)
+        while not self.queue.empty():
+            self.queue.get_nowait().finish(error)
+        self._reset()
+
+    async def submit(self, prompt, max_new_tokens=None):
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        if len(prompt) + max_new_tokens > self.context_size:
+            raise ValueError(f"Prompt length {len(prompt)} + {max_new_tokens} new tokens exceeds "
+                             f"the context size {self.context_size}")
+
+        # Backpressure: callers wait while the queue is full, up to the queue timeout
+        request = ScheduledRequest(list(prompt), max_new_tokens)
+        try:
+            await asyncio.wait_for(self.queue.put(request), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"Request queue full for {self.queue_timeout}s") from None
+        return request
+
+    async def generate(self, prompt, max_new_tokens=None):
+        # Generated token ids (without the prompt and the EOS)
+        request = await self.submit(prompt, max_new_tokens)
+        try:
+            return await request.done
+        finally:
+            request.cancelled = True
+
+    async def stream(self, prompt, max_new_tokens=None):
+        # Yields each token id as soon as the batch step that produced it has finished
+        request = await self.submit(prompt, max_new_tokens)
+        try:
+            while (token := await request.updates.get()) is not None:
+                yield token
+            await request.done  # Raises if the request failed
+        finally:
+            request.cancelled = True  # Frees the batch row if the consumer stopped early
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            admitted = []
+            if not self.rows:
+                admitted.append(await self.queue.get())  # Idle: wait for work
+            while len(self.rows) + len(admitted) < self.max_batch_size and not self.queue.empty():
+                admitted.append(self.queue.get_nowait())
+            admitted = [request for request in admitted if self._admissible(request)]
+            keep = [i for i, request in enumerate(self.rows) if not (request.cancelled or request.done.done())]
+            if not admitted and not keep:
+                await loop.run_in_executor(self.executor, self._reset)
+                continue
+
+            try:
+                emitted = await loop.run_in_executor(self.executor, self._step, keep, admitted)
+            except Exception as e:
+                # A failed step leaves the cache in an unknown state: fail the whole batch
+                for request in self.rows + admitted:
+                    request.finish(e)
+                await loop.run_in_executor(self.executor, self._reset)
+                continue
+
+            for request, token, finished in emitted:
+                if token is not None:
+                    request.tokens.append(token)
+                    request.updates.put_nowait(token)
+                if finished:
+                    request.finish()
+
+    def _admissible(self, request):
+        if request.cancelled or request.done.done():
+            return False
+        waited = time.monotonic() - request.enqueued_at
+        if waited > self.queue_timeout:
+            request.finish(asyncio.TimeoutError(f"Request waited {waited:.1f}s in the queue"))
+            return False
+        return True
+
+    def _reset(self):
+        self.model.reset_kv_cache()
+        self.rows, self.pad_lengths, self.logits = [], None, None
+
+    def _step(self, keep, admitted):
+        # One decode step for the whole batch: add the new requests, pick every row's next token,
+        # drop the finished rows and run the surviving ones through the model
+        with torch.no_grad():
+            if len(keep) < len(self.rows):
+                self._select_rows(keep)
+            if admitted:
+                self._admit(admitted)
+
+            next_tokens = select_next_token(self.logits, self.temperature, self.top_k).squeeze(1)
+            emitted, keep = [], []
+            for row, (request, token) in enumerate(zip(self.rows, next_tokens.tolist())):
+                if token == self.eos_id:
+                    emitted.append((request, None, True))
+                    continue
+                request.num_generated += 1
+                finished = request.num_generated >= request.max_new_tokens
+                emitted.append((request, token, finished))
+                if not finished:
+                    keep.append(row)
+
+            self._select_rows(keep)
+            if self.rows:
+                idx_next = next_tokens[keep][:, None]
+                self.logits = self.model(idx_next, use_cache=True, pad_lengths=self.pad_lengths)[:, -1, :]
+        return emitted
+
+    def _select_rows(self, keep):
+        self.rows = [self.rows[row] for row in keep]
+        if not self.rows:
+            self._reset()
+            return
+
+        rows = torch.tensor(keep, dtype=torch.long, device=self.device)
+        pad_lengths = self.pad_lengths[rows]
+        trim = int(pad_lengths.min())  # Columns that are padding in every remaining row
+        cache, current_pos = self.model.get_kv_cache()
+        cache = [(keys[rows, :, trim:], values[rows, :, trim:]) for keys, values in cache]
+        self.model.set_kv_cache(cache, current_pos - trim)
+        self.pad_lengths = pad_lengths - trim
+        self.logits = self.logits[rows]
+
+    def _admit(self, admitted):
+        # Prefill the new prompts as their own left-padded batch, with the running cache set aside
+        prompts = [request.prompt for request in admitted]
+        max_len = max(len(prompt) for prompt in prompts)
+        idx = torch.full((len(prompts), max_len), self.pad_id, dtype=torch.long, device=self.device)
+        for row, prompt in enumerate(prompts):
+            idx[row, max_len - len(prompt):] = torch.tensor(prompt, dtype=torch.long, device=self.device)
+        pad_lengths = torch.tensor([max_len - len(prompt) for prompt in prompts], device=self.device)
+
+        running_cache, running_len = self.model.get_kv_cache()
+        logits = prefill(self.model, idx, pad_lengths, self.prefix_cache)
+
+        if self.rows:
+            # Left-pad the shorter of the two caches; the extra columns count as padding
+            new_cache, _ = self.model.get_kv_cache()
+            total = max(running_len, max_len)
+            cache = [
+                (torch.cat([left_pad(k_run, total - running_len), left_pad(k_new, total - max_len)]),
+                 torch.cat([left_pad(v_run, total - running_len), left_pad(v_new, total - max_len)]))
+                for (k_run, v_run), (k_new, v_new) in zip(running_cache, new_cache)
+            ]
+            self.model.set_kv_cache(cache, total)
+            self.pad_lengths = torch.cat([self.pad_lengths + (total - running_len),
+                                          pad_lengths + (total - max_len)])
+            self.logits = torch.cat([self.logits, logits])
+        else:
+            self.pad_lengths, self.logits = pad_lengths, logits
+        self.rows = self.rows + admitted
+
+
+def left_pad(cache, num_tokens):
+    # (b, num_heads, num_tokens, head_dim) cache tensor with num_tokens zero columns in front
+    if num_tokens == 0:
+        return cache
+    return torch.nn.functional.pad(cache, (0, 0, num_tokens, 0))
@@ -0,0 +1,392 @@
+import io
+import os
+import sys
+import json
+import time
+import runpy
+import random
+import argparse
+import builtins
+import platform
+import resource
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from gpt_arc import GPT_CONFIG_124M, GPTModel, GPTDatasetV1, generate, generate_text_simple
+from gpt_arc import download_and_load_gpt2, load_weights_into_gpt, load_merged_checkpoint
+from gpt_arc import COMPILE_MODES, set_fused_kernels, compile_gpt, get_tokenizer
+from gpt_arc import speculative_decode, text_to_token_ids
+from updrs_prompts import format_input, format_instruction
+
+# Benchmarks for gpt_arc inference and the end-to-end assistant pipeline.
+#
+#   python benchmark.py --output bench.json                  # run every suite
+#   python benchmark.py --suite forward --suite generate     # only some of them
+#   python benchmark.py --suite speculative                  # speedup of the distilled draft model
+#   python benchmark.py --baseline bench.json                # compare against a stored run
+#
+# Every case reports p50/p95/mean latency in milliseconds, tokens/s where it applies and the
+# peak RSS while it ran. Each suite runs in a fresh process, so memory held by earlier suites
+# never counts towards a case. With --baseline, a case regresses when its p50 is
+# more than --tolerance slower than the stored one, and the exit code is 1.
+
+SUITES = ("forward", "generate", "speculative", "load", "dataset", "pipeline")
+
+# Same architecture as the assistant's fine-tuned model; weights are random unless loaded
+BENCH_CONFIG = dict(GPT_CONFIG_124M, context_length=1024, drop_rate=0.0, qkv_bias=True, fused_attn=True)
+
+FINAL_CODE_PATH = "final code.py"
+FINE_TUNED_PATH = "Fine_tuned_updrs_model.pth"
+MERGED_CHECKPOINT_PATH = "updrs_gpt_merged.pth"
+DRAFT_CHECKPOINT_PATH = "updrs_gpt_draft.pth"
+DATASET_PATH = "LLM_UPDRS_5000_dataset_FIXED_HYPHEN.json"
+
+
+def reset_peak_rss():
+    # Linux: restart the VmHWM high-water mark, so every case reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    # VmHWM (peak since the last reset_peak_rss) where there is one; otherwise ru_maxrss, the
+    # peak of the suite's process so far
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    low, high = int(pos), min(int(pos) + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def measure(fn, repeat, warmup=1):
+    reset_peak_rss()
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(timings, tokens=None, **extra):
+    # tokens: number of tokens produced (or processed) per call, for tokens/s
+    result = {
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "repeat": len(timings),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if tokens:
+        result["tokens_per_s"] = tokens * len(timings) / sum(timings)
+    result.update(extra)
+    return result
+
+
+def skipped(reason):
+    return {"skipped": reason}
+
+
+#####################################
+# Suites: each one returns {case_name: result}
+
+def bench_model(args, device):
+    model = GPTModel(BENCH_CONFIG).to(device).eval()
+    if args.fast_kernels:
+        set_fused_kernels(model)
+    return compile_gpt(model, args.compile)
+
+
+def bench_forward(args, device):
+    model = bench_model(args, device)
+    results = {}
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            for seq_len in args.seq_lens:
+                idx = torch.randint(0, BENCH_CONFIG["vocab_size"], (batch_size, seq_len), device=device)
+                timings = measure(lambda: model(idx), args.repeat)
+                results[f"forward/b{batch_size}_t{seq_len}"] = summarize(timings, tokens=batch_size * seq_len)
+    return results
+
+
+def bench_generate(args, device):
+    model = bench_model(args, device)
+    prompt = torch.randint(0, BENCH_CONFIG["vocab_size"], (1, args.prompt_len), device=device)
+    context_size = BENCH_CONFIG["context_length"]
+    n = args.new_tokens
+    results = {}
+    with torch.no_grad():
+        for use_cache in (True, False):
+            name = "cached" if use_cache else "uncached"
+            timings = measure(lambda: generate(model, prompt, n, context_size, use_cache=use_cache), args.repeat)
+            results[f"generate/{name}"] = summarize(timings, tokens=n, per_token_ms=percentile(timings, 0.5) * 1000 / n)
+
+            timings = measure(lambda: generate_text_simple(model, prompt, n, context_size, use_cache=use_cache),
+                              args.repeat)
+            results[f"generate_text_simple/{name}"] = summarize(
+                timings, tokens=n, per_token_ms=percentile(timings, 0.5) * 1000 / n)
+    return results
+
+
+def bench_speculative(args, device):
+    # Greedy decoding of an assistant prompt with and without the draft model. With the merged and
+    # distilled draft checkpoints this is the real speedup; without them both models have random
+    # weights, almost every proposal is rejected and the case shows the cost of speculating instead.
+    import updrs_pipeline
+    from distill_updrs_draft import draft_config
+
+    if os.path.exists(MERGED_CHECKPOINT_PATH) and os.path.exists(DRAFT_CHECKPOINT_PATH):
+        model = load_merged_checkpoint(MERGED_CHECKPOINT_PATH, device)
+        draft = load_merged_checkpoint(DRAFT_CHECKPOINT_PATH, device)
+        weights = "trained"
+    else:
+        model = GPTModel(BENCH_CONFIG).to(device).eval()
+        draft = GPTModel(draft_config()).to(device).eval()
+        weights = "random"
+    if args.fast_kernels:
+        set_fused_kernels(model)
+        set_fused_kernels(draft)
+
+    prompt = text_to_token_ids(format_input(format_instruction(30)), get_tokenizer()).to(device)
+    context_size = BENCH_CONFIG["context_length"]
+    n, k, eos_id = args.new_tokens, args.num_speculative, updrs_pipeline.EOS_ID
+    with torch.no_grad():
+        # Both runs produce the same tokens (stopping at the same end-of-sequence token)
+        num_new = generate(model, prompt, n, context_size, eos_id=eos_id).shape[1] - prompt.shape[1]
+        rounds = list(speculative_decode(model, draft, prompt, n, k, eos_id))
+        accepted, proposed = sum(r[1] for r in rounds), sum(r[2] for r in rounds)
+
+        greedy = measure(lambda: generate(model, prompt, n, context_size, eos_id=eos_id), args.repeat)
+        speculative = measure(lambda: generate(model, prompt, n, context_size, eos_id=eos_id,
+                                               draft_model=draft, num_speculative=k), args.repeat)
+    return {
+        "speculative/greedy": summarize(greedy, tokens=num_new, weights=weights),
+        "speculative/draft": summarize(
+            speculative, tokens=num_new, weights=weights, num_speculative=k,
+            acceptance_rate=accepted / max(proposed, 1),
+            speedup=percentile(greedy, 0.5) / percentile(speculative, 0.5)),
+    }
+
+
+def bench_load(args, device):
+    results = {}
+
+    def load_tf_checkpoint():
+        settings, params = download_and_load_gpt2(model_size="124M", models_dir=args.gpt2_dir, offline=True)
+        load_weights_into_gpt(GPTModel(BENCH_CONFIG), params)
+
+    # The GPT-2 download is never timed: only an existing local cache is loaded
+    try:
+        results["load/tf_checkpoint"] = summarize(measure(load_tf_checkpoint, args.load_repeat, warmup=0))
+    except (FileNotFoundError, RuntimeError, ImportError) as e:
+        results["load/tf_checkpoint"] = skipped(repr(e))
+
+    if os.path.exists(FINE_TUNED_PATH):
+        timings = measure(lambda: torch.load(FINE_TUNED_PATH, map_location="cpu"), args.load_repeat, warmup=0)
+        results["load/fine_tuned_torch_load"] = summarize(timings)
+    else:
+        results["load/fine_tuned_torch_load"] = skipped(f"{FINE_TUNED_PATH} not found")
+
+    if os.path.exists(MERGED_CHECKPOINT_PATH):
+        timings = measure(lambda: load_merged_checkpoint(MERGED_CHECKPOINT_PATH, device), args.load_repeat, warmup=0)
+        results["load/merged_checkpoint_mmap"] = summarize(timings)
+    else:
+        results["load/merged_checkpoint_mmap"] = skipped(f"{MERGED_CHECKPOINT_PATH} not found")
+    return results
+
+
+def bench_dataset(args, device):
+    if not os.path.exists(args.dataset_text):
+        return {"dataset/gpt_dataset_v1": skipped(f"{args.dataset_text} not found")}
+    with open(args.dataset_text, "r", encoding="utf-8") as file:
+        text = file.read()
+    tokenizer = get_tokenizer()
+    num_tokens = len(tokenizer.encode(text, allowed_special={"<|endoftext|>"}))
+    timings = measure(lambda: GPTDatasetV1(text, tokenizer, max_length=256, stride=128), args.load_repeat)
+    return {"dataset/gpt_dataset_v1": summarize(timings, tokens=num_tokens, num_tokens=num_tokens)}
+
+
+def scripted_answers(questions, seed):
+    # One valid answer per question, in the order ask_questionnaire asks them
+    rng = random.Random(seed)
+    return [rng.choice(sorted(q["choices"])) for q in questions]
+
+
+def bench_pipeline(args, device):
+    # The questionnaire and the pipeline of `final code.py` in local mode, with input() answered
+    # from a script. The models are loaded up front, so loading is not part of the timings.
+    import updrs_pipeline
+
+    client = runpy.run_path(FINAL_CODE_PATH)
+    updrs_pipeline.configure(precision=args.precision, offline=True, fast=args.fast_kernels,
+                             compile_mode=args.compile)
+    response_table = None if args.no_response_table else updrs_pipeline.load_updrs_response_table()
+    try:
+        updrs_pipeline.load_ml_models()
+        updrs_pipeline.load_llm()
+    except (FileNotFoundError, RuntimeError) as e:
+        return {"pipeline/assessment": skipped(repr(e))}
+
+    first_chunk_ms = []  # Time to the first recommendation text, per run
+
+    def run_once():
+        answers = iter(scripted_answers(client["questions"], seed=len(first_chunk_ms)))
+        first_chunk = None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            original_input, builtins.input = builtins.input, lambda prompt="": next(answers)
+            try:
+                responses = client["ask_questionnaire"]()
+            finally:
+                builtins.input = original_input
+            for event in updrs_pipeline.stream_assessment(responses, response_table):
+                if first_chunk is None and "text" in event:
+                    first_chunk = (time.perf_counter() - start) * 1000
+        first_chunk_ms.append(first_chunk)
+
+    timings = measure(run_once, args.repeat)
+    first_chunk_ms = first_chunk_ms[1:]  # Drop the warmup run
+    return {"pipeline/assessment": summarize(
+        timings,
+        first_chunk_p50_ms=percentile([ms for ms in first_chunk_ms if ms is not None] or [0.0], 0.5),
+        response_table=response_table is not None,
+        precision=args.precision,
+    )}
+
+
+BENCHMARKS = {
+    "forward": bench_forward,
+    "generate": bench_generate,
+    "speculative": bench_speculative,
+    "load": bench_load,
+    "dataset": bench_dataset,
+    "pipeline": bench_pipeline,
+}
+
+
+def run_suite(suite, args, device):
+    # Entry point of the per-suite process
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    return BENCHMARKS[suite](args, device)
+
+
+#####################################
+
+def environment(device):
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "device": str(device),
+        "num_threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Returns the names of the cases whose p50 regressed by more than `tolerance`
+    regressions = []
+    print(f"\n{'case':<40}{'baseline p50':>15}{'current p50':>15}{'change':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or "p50_ms" not in base or "p50_ms" not in result:
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40}{base['p50_ms']:>13.2f}ms{result['p50_ms']:>13.2f}ms{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gpt_arc and assistant pipeline benchmarks")
+    parser.add_argument("--suite", action="append", choices=SUITES,
+                        help="Suite to run (repeatable); default: all")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed p50 slowdown against the baseline (0.10 = 10%%)")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--load-repeat", type=int, default=3,
+                        help="Repetitions of the (slow) loading and dataset cases")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--prompt-len", type=int, default=64)
+    parser.add_argument("--new-tokens", type=int, default=50)
+    parser.add_argument("--num-speculative", type=int, default=4,
+                        help="Draft tokens proposed per verification pass in the speculative suite")
+    parser.add_argument("--gpt2-dir", default="gpt2")
+    parser.add_argument("--dataset-text", default=DATASET_PATH,
+                        help="Text file used for the GPTDatasetV1 construction case")
+    parser.add_argument("--precision", default="fp32", help="Assistant LLM precision for the pipeline suite")
+    parser.add_argument("--no-response-table", action="store_true",
+                        help="Generate every recommendation in the pipeline suite")
+    parser.add_argument("--fast-kernels", action="store_true",
+                        help="Native fused LayerNorm/GELU kernels in the forward, generate and pipeline suites")
+    parser.add_argument("--compile", choices=COMPILE_MODES, default="none",
+                        help="Compile mode for the forward, generate and pipeline suites")
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    parser.add_argument("--seed", type=int, default=123)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    results = {}
+    spawn = multiprocessing.get_context("spawn")
+    for suite in args.suite or SUITES:
+        print(f"Running {suite} ...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            suite_results = pool.submit(run_suite, suite, args, device).result()
+        for name, result in suite_results.items():
+            results[name] = result
+            if "skipped" in result:
+                print(f"  {name}: skipped ({result['skipped']})")
+            else:
+                extra = f", {result['tokens_per_s']:.1f} tok/s" if "tokens_per_s" in result else ""
+                print(f"  {name}: p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms{extra}")
+
+    report = {"environment": environment(device), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            raise SystemExit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
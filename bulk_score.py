@@ -0,0 +1,197 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import joblib
+
+from question_bank import load_question_bank
+
+# Bulk scoring of recorded UPDRS questionnaires (spreadsheet, CSV or JSONL), chunk by chunk:
+#
+#   python bulk_score.py "Final Data set_V1.xlsx" --output scores.parquet
+#   python bulk_score.py visits.csv --output scores.csv --keep-columns patient_id visit_date
+#
+# Every row holds the 59 answers in columns named after the question ids ("1".."59", or "Q1"..).
+# Answers are validated against each question's choices, Part I–IV and total scores are computed
+# with array operations, and the ML prediction runs once per chunk on the valid rows.
+# Rows with a missing or invalid answer are kept, with valid=False and no scores or prediction.
+
+ML_MODEL_PATH = "logistic_model.pkl"
+LABEL_ENCODER_PATH = "label_encoder.pkl"
+
+
+class ScoringTables:
+    # Per-question lookup tables, built once and applied to whole chunks
+    def __init__(self, questions):
+        self.question_ids = [q["question_id"] for q in questions]
+        max_value = max(int(k) for q in questions for k in q["choices"])
+
+        # allowed[i, v]: answer v is one of question i's choices
+        self.allowed = np.zeros((len(questions), max_value + 1), dtype=bool)
+        for i, q in enumerate(questions):
+            self.allowed[i, [int(k) for k in q["choices"]]] = True
+
+        # membership[i, s]: question i belongs to section s (Part I, Part II, ...)
+        self.sections = list(dict.fromkeys(q["section"] for q in questions))
+        self.membership = np.zeros((len(questions), len(self.sections)), dtype=np.int64)
+        for i, q in enumerate(questions):
+            self.membership[i, self.sections.index(q["section"])] = 1
+
+    def section_columns(self):
+        return [section.lower().replace(" ", "_") + "_score" for section in self.sections]
+
+    def validate(self, values):
+        # values: (rows, questions) floats, NaN where the answer is missing or not a number.
+        # Returns the answers as integers and a (rows, questions) mask of the valid ones.
+        finite = np.isfinite(values)
+        integral = finite & (values == np.round(np.where(finite, values, 0)))
+        in_range = integral & (values >= 0) & (values < self.allowed.shape[1])
+        answers = np.where(in_range, values, 0).astype(np.int64)
+        valid = in_range & self.allowed[np.arange(len(self.question_ids))[None, :], answers]
+        return answers, valid
+
+    def score(self, answers):
+        # Section scores (rows, sections) and totals (rows,)
+        section_scores = answers @ self.membership
+        return section_scores, section_scores.sum(axis=1)
+
+
+def answer_columns(columns, question_ids):
+    # Maps every question id to its column: "12", "Q12" or "q12"
+    lookup = {}
+    for column in columns:
+        name = str(column).strip().lower()
+        lookup.setdefault(name[1:] if name.startswith("q") else name, column)
+    missing = [qid for qid in question_ids if qid not in lookup]
+    if missing:
+        raise ValueError(f"No column for question(s) {', '.join(missing)}")
+    return [lookup[qid] for qid in question_ids]
+
+
+def read_chunks(path, chunk_size, sheet=None):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        yield from pd.read_csv(path, chunksize=chunk_size, low_memory=False)
+    elif extension in (".jsonl", ".ndjson"):
+        yield from pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False)
+    elif extension in (".xlsx", ".xlsm"):
+        yield from read_excel_chunks(path, chunk_size, sheet)
+    else:
+        raise ValueError(f"Unsupported input format {extension!r} (use .xlsx, .csv or .jsonl)")
+
+
+def read_excel_chunks(path, chunk_size, sheet=None):
+    # openpyxl's read-only mode streams the rows instead of loading the whole workbook
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+        header = [str(name) for name in next(rows)]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+def score_chunk(chunk, tables, ml_model, label_encoder, keep_columns=()):
+    columns = answer_columns(chunk.columns, tables.question_ids)
+    values = chunk[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    answers, valid_answers = tables.validate(values)
+    valid = valid_answers.all(axis=1)
+    section_scores, totals = tables.score(answers)
+
+    result = pd.DataFrame({column: chunk[column].to_numpy() for column in keep_columns})
+    for s, column in enumerate(tables.section_columns()):
+        result[column] = pd.array(section_scores[:, s], dtype="Int64")
+    result["updrs_score"] = pd.array(totals, dtype="Int64")
+    result["valid"] = valid
+    result["invalid_items"] = (~valid_answers).sum(axis=1)
+    score_columns = tables.section_columns() + ["updrs_score"]
+    result.loc[~valid, score_columns] = pd.NA
+
+    # One predict and one inverse_transform for all valid rows of the chunk
+    predictions = np.full(len(chunk), None, dtype=object)
+    if valid.any():
+        encoded = ml_model.predict(totals[valid].reshape(-1, 1))
+        predictions[valid] = label_encoder.inverse_transform(encoded)
+    result["prediction"] = predictions
+    return result
+
+
+class ResultWriter:
+    # Appends scored chunks to a Parquet or CSV file
+    def __init__(self, path):
+        self.path = path
+        self.parquet = os.path.splitext(path)[1].lower() == ".parquet"
+        self.writer = None
+        self.rows = 0
+
+    def write(self, frame):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            frame = frame.astype({"prediction": "string"})
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        else:
+            frame.to_csv(self.path, mode="w" if self.rows == 0 else "a", header=self.rows == 0, index=False)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def bulk_score(input_path, output_path, chunk_size=50_000, sheet=None, keep_columns=(),
+               questions=None, ml_model_path=ML_MODEL_PATH, label_encoder_path=LABEL_ENCODER_PATH):
+    tables = ScoringTables(questions if questions is not None else load_question_bank().questions)
+    ml_model = joblib.load(ml_model_path)
+    label_encoder = joblib.load(label_encoder_path)
+
+    # Written to a temporary file first so an interrupted run never leaves a truncated output
+    tmp_path = output_path + ".tmp" + os.path.splitext(output_path)[1]
+    writer = ResultWriter(tmp_path)
+    invalid_rows = 0
+    try:
+        for chunk in read_chunks(input_path, chunk_size, sheet):
+            result = score_chunk(chunk, tables, ml_model, label_encoder, keep_columns)
+            writer.write(result)
+            invalid_rows += int((~result["valid"]).sum())
+            print(f"Scored {writer.rows} rows ({invalid_rows} with missing or invalid answers)")
+    finally:
+        writer.close()
+    os.replace(tmp_path, output_path)
+    return writer.rows, invalid_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score recorded UPDRS questionnaires in bulk")
+    parser.add_argument("input", help=".xlsx, .csv or .jsonl file with one visit per row")
+    parser.add_argument("--output", required=True, help="Output .parquet or .csv file")
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--sheet", help="Worksheet name (default: the first one)")
+    parser.add_argument("--keep-columns", nargs="*", default=[],
+                        help="Input columns copied to the output, e.g. patient and visit ids")
+    parser.add_argument("--ml-model", default=ML_MODEL_PATH)
+    parser.add_argument("--label-encoder", default=LABEL_ENCODER_PATH)
+    args = parser.parse_args()
+
+    rows, invalid_rows = bulk_score(args.input, args.output, args.chunk_size, args.sheet, args.keep_columns,
+                                    ml_model_path=args.ml_model, label_encoder_path=args.label_encoder)
+    print(f"✅ {rows} rows scored ({invalid_rows} invalid), results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import json
+import random
+import argparse
+
+import torch
+
+from gpt_arc import GPTModel, save_merged_checkpoint, speculative_decode, text_to_token_ids, get_tokenizer
+from finetune_updrs import create_instruction_dataloader
+from updrs_prompts import format_input
+import updrs_pipeline
+
+# Distills the fine-tuned UPDRS GPT into a small draft model for speculative decoding:
+#
+#   python distill_updrs_draft.py --n-layers 4 --emb-dim 256 --output updrs_gpt_draft.pth
+#
+# Every proposal costs a full draft forward pass, so the draft is narrow as well as shallow: at
+# the defaults (4 layers, 256 wide, output head tied to the token embeddings) one step is about
+# an eighth of the fine-tuned model's, most of it in the 50257-way output head. Its embeddings start
+# from the fine-tuned model's, projected onto their leading principal directions; the blocks start
+# from scratch. It is trained on LLM_UPDRS_5000_dataset_FIXED_HYPHEN.json to match the fine-tuned
+# model's next-token distributions on the response tokens (plus the usual cross-entropy on the
+# dataset responses). The fine-tuned model's outputs are very formulaic, so a small model is
+# enough for most proposals to be accepted.
+
+
+def draft_config(n_layers=4, emb_dim=256, n_heads=4):
+    return dict(updrs_pipeline.BASE_CONFIG, n_layers=n_layers, emb_dim=emb_dim, n_heads=n_heads, tie_weights=True)
+
+
+def init_draft_from_teacher(teacher, cfg):
+    # Token and position embeddings are the teacher's, projected onto the top emb_dim right
+    # singular vectors of its token embedding matrix; blocks, final norm and head (tied) are new
+    draft = GPTModel(cfg)
+    with torch.no_grad():
+        tok_emb = teacher.tok_emb.weight.float()
+        _, _, v = torch.linalg.svd(tok_emb, full_matrices=False)
+        projection = v[:cfg["emb_dim"]].T
+        draft.tok_emb.weight.copy_(tok_emb @ projection)
+        draft.pos_emb.weight.copy_(teacher.pos_emb.weight.float()[:cfg["context_length"]] @ projection)
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    draft_params = sum(p.numel() for p in draft.parameters())
+    print(f"Draft model: {draft_params / 1e6:.1f}M parameters ({draft_params / teacher_params:.0%} of the teacher)")
+    return draft
+
+
+def distillation_loss(draft_logits, teacher_logits, targets, temperature=1.0, alpha=0.5, ignore_index=-100):
+    # alpha * KL(teacher || draft) on the softened distributions + (1 - alpha) * cross-entropy,
+    # both over the response tokens only (the positions with a target)
+    mask = targets != ignore_index
+    draft_logits, teacher_logits = draft_logits[mask], teacher_logits[mask]
+    kl = torch.nn.functional.kl_div(
+        torch.log_softmax(draft_logits / temperature, dim=-1),
+        torch.log_softmax(teacher_logits / temperature, dim=-1),
+        log_target=True, reduction="batchmean") * temperature ** 2
+    ce = torch.nn.functional.cross_entropy(draft_logits, targets[mask])
+    return alpha * kl + (1 - alpha) * ce
+
+
+def evaluate_distillation(draft, teacher, data_loader, device, temperature, alpha, num_batches=None):
+    draft.eval()
+    total, count = 0.0, 0
+    with torch.no_grad():
+        for i, (input_batch, target_batch) in enumerate(data_loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+            total += distillation_loss(draft(input_batch), teacher(input_batch), target_batch,
+                                       temperature, alpha).item()
+            count += 1
+    draft.train()
+    return total / max(count, 1)
+
+
+def train_draft(draft, teacher, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter,
+                temperature=1.0, alpha=0.5):
+    teacher.eval()
+    draft.train()
+    global_step = 0
+    for epoch in range(num_epochs):
+        train_loader.batch_sampler.set_epoch(epoch)
+        for input_batch, target_batch in train_loader:
+            input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+            with torch.no_grad():
+                teacher_logits = teacher(input_batch)
+            optimizer.zero_grad()
+            loss = distillation_loss(draft(input_batch), teacher_logits, target_batch, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+            global_step += 1
+
+            if global_step % eval_freq == 0:
+                val_loss = evaluate_distillation(draft, teacher, val_loader, device, temperature, alpha, eval_iter)
+                print(f"Ep {epoch + 1} (Step {global_step:06d}): "
+                      f"Train loss {loss.item():.3f}, Val loss {val_loss:.3f}")
+    draft.eval()
+
+
+def acceptance_rate(teacher, draft, data, tokenizer, device, num_speculative, max_new_tokens, eos_id):
+    # Share of proposed draft tokens the fine-tuned model accepts, on greedy decoding of the prompts
+    accepted, proposed = 0, 0
+    for entry in data:
+        idx = text_to_token_ids(format_input(entry["instruction"]), tokenizer).to(device)
+        for _, num_accepted, num_proposed in speculative_decode(teacher, draft, idx, max_new_tokens,
+                                                                num_speculative, eos_id):
+            accepted += num_accepted
+            proposed += num_proposed
+    return accepted / max(proposed, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill the fine-tuned UPDRS GPT into a speculative draft model")
+    parser.add_argument("--data", default=updrs_pipeline.dataset_path)
+    parser.add_argument("--output", default=updrs_pipeline.draft_model_path)
+    parser.add_argument("--n-layers", type=int, default=4, help="TransformerBlocks in the draft model")
+    parser.add_argument("--emb-dim", type=int, default=256, help="Embedding width of the draft model")
+    parser.add_argument("--n-heads", type=int, default=4, help="Attention heads per draft TransformerBlock")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=5e-4)
+    parser.add_argument("--weight-decay", type=float, default=0.1)
+    parser.add_argument("--temperature", type=float, default=2.0, help="Softmax temperature of the KL term")
+    parser.add_argument("--alpha", type=float, default=0.5, help="Weight of the KL term against cross-entropy")
+    parser.add_argument("--val-ratio", type=float, default=0.1)
+    parser.add_argument("--eval-freq", type=int, default=50)
+    parser.add_argument("--eval-iter", type=int, default=5)
+    parser.add_argument("--num-speculative", type=int, default=4)
+    parser.add_argument("--acceptance-samples", type=int, default=50,
+                        help="Validation prompts used to report the acceptance rate")
+    parser.add_argument("--offline", action="store_true",
+                        help="Never download the GPT-2 checkpoint; fail if it is not in the local cache")
+    parser.add_argument("--seed", type=int, default=123)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = get_tokenizer()
+
+    with open(args.data, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    random.Random(args.seed).shuffle(data)
+    val_size = int(len(data) * args.val_ratio)
+    train_data, val_data = data[val_size:], data[:val_size]
+    print("Training set length:", len(train_data))
+    print("Validation set length:", len(val_data))
+
+    context_length = updrs_pipeline.BASE_CONFIG["context_length"]
+    train_loader = create_instruction_dataloader(
+        train_data, tokenizer, batch_size=args.batch_size, shuffle=True, drop_last=True,
+        allowed_max_length=context_length, seed=args.seed)
+    val_loader = create_instruction_dataloader(
+        val_data, tokenizer, batch_size=args.batch_size, shuffle=False, drop_last=False,
+        allowed_max_length=context_length, seed=args.seed)
+
+    updrs_pipeline.configure(offline=args.offline)
+    teacher = updrs_pipeline.load_fp32_llm().to(device).eval()
+    for param in teacher.parameters():
+        param.requires_grad_(False)
+    cfg = draft_config(args.n_layers, args.emb_dim, args.n_heads)
+    draft = init_draft_from_teacher(teacher, cfg).to(device)
+
+    optimizer = torch.optim.AdamW(draft.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    train_draft(draft, teacher, train_loader, val_loader, optimizer, device, args.epochs,
+                args.eval_freq, args.eval_iter, args.temperature, args.alpha)
+
+    save_merged_checkpoint(draft, cfg, args.output)
+    print(f"Draft model saved to {args.output}")
+
+    rate = acceptance_rate(teacher, draft, val_data[:args.acceptance_samples], tokenizer, device,
+                           args.num_speculative, updrs_pipeline.MAX_NEW_TOKENS, updrs_pipeline.EOS_ID)
+    print(f"Acceptance rate ({args.num_speculative} proposals per pass): {rate:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import json
+import random
+import argparse
+from functools import partial
+
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
+
+from gpt_arc import GPT_CONFIG_124M, GPTModel, download_and_load_gpt2, load_weights_into_gpt
+from gpt_arc import train_model, get_tokenizer, file_sha256
+from updrs_prompts import format_input, format_response
+
+# Instruction fine-tuning of GPT-2 124M on LLM_UPDRS_5000_dataset_FIXED_HYPHEN.json.
+# Produces the same checkpoint layout as Fine_tuned_updrs_model.pth.
+
+BASE_CONFIG = dict(GPT_CONFIG_124M, context_length=1024, drop_rate=0.0, qkv_bias=True, fused_attn=True)
+
+
+class InstructionDataset(Dataset):
+    def __init__(self, data, tokenizer):
+        self.encoded_texts = []
+        self.prompt_lengths = []
+
+        # Prompt and response are encoded separately so the prompt tokens are exactly
+        # the ones the model sees at inference time, and can be masked out of the loss.
+        # Batch encoding: the shared tokenizer caches the many repeated prompts and responses.
+        prompts = tokenizer.encode_batch([format_input(entry["instruction"]) for entry in data])
+        responses = tokenizer.encode_batch([format_response(entry["output"]) for entry in data])
+        for prompt_ids, response_ids in zip(prompts, responses):
+            self.encoded_texts.append(prompt_ids + response_ids)
+            self.prompt_lengths.append(len(prompt_ids))
+
+    def __len__(self):
+        return len(self.encoded_texts)
+
+    def __getitem__(self, idx):
+        return self.encoded_texts[idx], self.prompt_lengths[idx]
+
+
+def instruction_collate_fn(batch, pad_token_id=50256, ignore_index=-100, allowed_max_length=None):
+    # Pad to the longest sequence in this batch (+1 for the appended end-of-text token),
+    # not to the context length
+    batch_max_length = max(len(item) + 1 for item, _ in batch)
+
+    inputs_lst, targets_lst = [], []
+    for item, prompt_length in batch:
+        new_item = item + [pad_token_id]
+        padded = new_item + [pad_token_id] * (batch_max_length - len(new_item))
+        inputs = torch.tensor(padded[:-1])
+        targets = torch.tensor(padded[1:])
+
+        # The first end-of-text token stays a target, the remaining padding is ignored
+        targets[len(item):] = ignore_index
+        # Prompt tokens are given, not predicted
+        targets[:prompt_length - 1] = ignore_index
+
+        if allowed_max_length is not None:
+            inputs = inputs[:allowed_max_length]
+            targets = targets[:allowed_max_length]
+
+        inputs_lst.append(inputs)
+        targets_lst.append(targets)
+
+    return torch.stack(inputs_lst), torch.stack(targets_lst)
+
+
+class LengthBucketSampler(Sampler):
+    # Batches examples of similar length together so per-batch padding stays small:
+    # shuffle, cut into buckets of batch_size * bucket_multiplier, sort each bucket by length,
+    # split it into batches and shuffle the batch order
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, bucket_multiplier=50, seed=123):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_multiplier
+        self.seed = seed
+        self.epoch = 0
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            for b in range(0, len(bucket), self.batch_size):
+                batch = bucket[b:b + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def set_epoch(self, epoch):
+        # Called by gpt_arc.train_model, so a resumed run reproduces the epoch's batch order
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
+
+def create_instruction_dataloader(data, tokenizer, batch_size=8, shuffle=True, drop_last=False,
+                                  num_workers=0, allowed_max_length=1024, seed=123):
+    dataset = InstructionDataset(data, tokenizer)
+    batch_sampler = LengthBucketSampler(
+        [len(item) for item in dataset.encoded_texts],
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+        seed=seed
+    )
+    return DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=partial(instruction_collate_fn, allowed_max_length=allowed_max_length),
+        num_workers=num_workers
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Instruction fine-tuning on the UPDRS dataset")
+    parser.add_argument("--data", default="LLM_UPDRS_5000_dataset_FIXED_HYPHEN.json")
+    parser.add_argument("--output", default="Fine_tuned_updrs_model.pth")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--accumulation-steps", type=int, default=1)
+    parser.add_argument("--lr", type=float, default=5e-5)
+    parser.add_argument("--weight-decay", type=float, default=0.1)
+    parser.add_argument("--val-ratio", type=float, default=0.1)
+    parser.add_argument("--eval-freq", type=int, default=50)
+    parser.add_argument("--eval-iter", type=int, default=5)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast (CPU or GPU)")
+    parser.add_argument("--gradient-checkpointing", action="store_true",
+                        help="Recompute TransformerBlock activations in backward to save memory")
+    parser.add_argument("--tie-weights", action="store_true",
+                        help="Share the token embedding matrix with the output head, as in the original GPT-2")
+    parser.add_argument("--checkpoint", default="finetune_updrs_checkpoint.pth",
+                        help="Training checkpoint, written periodically and deleted once the run completes")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from --checkpoint (same data and hyperparameters)")
+    parser.add_argument("--checkpoint-freq", type=int, default=100,
+                        help="Optimizer steps between training checkpoints")
+    parser.add_argument("--seed", type=int, default=123)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = get_tokenizer()
+
+    with open(args.data, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    random.Random(args.seed).shuffle(data)
+    val_size = int(len(data) * args.val_ratio)
+    train_data, val_data = data[val_size:], data[:val_size]
+    print("Training set length:", len(train_data))
+    print("Validation set length:", len(val_data))
+
+    train_loader = create_instruction_dataloader(
+        train_data, tokenizer, batch_size=args.batch_size, shuffle=True, drop_last=True,
+        num_workers=args.num_workers, allowed_max_length=BASE_CONFIG["context_length"], seed=args.seed)
+    val_loader = create_instruction_dataloader(
+        val_data, tokenizer, batch_size=args.batch_size, shuffle=False, drop_last=False,
+        num_workers=args.num_workers, allowed_max_length=BASE_CONFIG["context_length"], seed=args.seed)
+
+    settings, params = download_and_load_gpt2(model_size="124M", models_dir="gpt2")
+    model = GPTModel(dict(BASE_CONFIG, tie_weights=args.tie_weights))
+    load_weights_into_gpt(model, params)
+    model.to(device)
+
+    # Everything that changes the training trajectory; a resumed checkpoint has to match it
+    fingerprint = {"data": file_sha256(args.data), "batch_size": args.batch_size,
+                   "accumulation_steps": args.accumulation_steps, "lr": args.lr,
+                   "weight_decay": args.weight_decay, "val_ratio": args.val_ratio, "bf16": args.bf16,
+                   "tie_weights": args.tie_weights, "seed": args.seed}
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    train_model(
+        model, train_loader, val_loader, optimizer, device,
+        num_epochs=args.epochs, eval_freq=args.eval_freq, eval_iter=args.eval_iter,
+        accumulation_steps=args.accumulation_steps, use_bf16=args.bf16,
+        gradient_checkpointing=args.gradient_checkpointing,
+        checkpoint_path=args.checkpoint, checkpoint_freq=args.checkpoint_freq,
+        resume=args.resume, fingerprint=fingerprint
+    )
+
+    tmp_path = args.output + ".tmp"
+    torch.save({"Fine_tuned_model_state_dict": model.state_dict()}, tmp_path)
+    os.replace(tmp_path, args.output)
+    print(f"Fine-tuned model saved to {args.output}")
+    # The run is complete: a leftover checkpoint would only be resumed into a zero-step run
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,50 @@
+import os
+import json
+import codecs
+import random
+import hashlib
+import threading
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
+import numpy as np
+import requests  # Make sure requests is installed
+import tiktoken
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+# TensorFlow is only needed to read the original GPT-2 checkpoint, so it is
+# imported inside the functions that use it instead of at module import time.
 
 class LayerNorm(nn.Module):
-    def __init__(self, emb_dim):
+    def __init__(self, emb_dim, fused=False):
         super().__init__()
         self.eps = 1e-5
         self.scale = nn.Parameter(torch.ones(emb_dim))
         self.shift = nn.Parameter(torch.zeros(emb_dim))
+        self.fused = fused  # Native layer_norm kernel: one pass, no intermediate tensors
 
     def forward(self, x):
+        if self.fused:
+            return nn.functional.layer_norm(x, self.scale.shape, self.scale, self.shift, self.eps)
         mean = x.mean(dim=-1, keepdim=True)
         var = x.var(dim=-1, keepdim=True, unbiased=False)
         norm_x = (x - mean) / torch.sqrt(var + self.eps)
         return self.scale * norm_x + self.shift
 
 class GELU(nn.Module):
-    def __init__(self):
+    def __init__(self, fused=False):
         super().__init__()
+        self.fused = fused  # Native kernel for the same tanh approximation
 
     def forward(self, x):
+        if self.fused:
+            return nn.functional.gelu(x, approximate="tanh")
         return 0.5 * x * (1 + torch.tanh(
             torch.sqrt(torch.tensor(2.0 / torch.pi)) *
             (x + 0.044715 * torch.pow(x, 3))
@@ -31,7 +56,7 @@ class FeedForward(nn.Module):
         super().__init__()
         self.layers = nn.Sequential(
             nn.Linear(cfg["emb_dim"], 4 * cfg["emb_dim"]), ## Expansion
-            GELU(), ## Activation
+            GELU(fused=cfg.get("fused_kernels", False)), ## Activation
             nn.Linear(4 * cfg["emb_dim"], cfg["emb_dim"]), ## Contraction
         )
 
@@ -39,7 +64,7 @@ class FeedForward(nn.Module):
         return self.layers(x)
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_in, d_out, context_length, dropout, num_heads, qkv_bias=False):
+    def __init__(self, d_in, d_out, context_length, dropout, num_heads, qkv_bias=False, fused=False):
         super().__init__()
         assert (d_out % num_heads == 0), \
             "d_out must be divisible by num_heads"
@@ -48,9 +73,15 @@ class MultiHeadAttention(nn.Module):
         self.num_heads = num_heads
         self.head_dim = d_out // num_heads # Reduce the projection dim to match desired output dim
 
-        self.W_query = nn.Linear(d_in, d_out, bias=qkv_bias)
-        self.W_key = nn.Linear(d_in, d_out, bias=qkv_bias)
-        self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
+        # fused=True packs Q/K/V into a single projection and uses torch's
+        # scaled_dot_product_attention; fused=False keeps the explicit reference path
+        self.fused = fused
+        if fused:
+            self.W_qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
+        else:
+            self.W_query = nn.Linear(d_in, d_out, bias=qkv_bias)
+            self.W_key = nn.Linear(d_in, d_out, bias=qkv_bias)
+            self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
         self.out_proj = nn.Linear(d_out, d_out)  # Linear layer to combine head outputs
         self.dropout = nn.Dropout(dropout)
         self.register_buffer(
@@ -59,38 +90,88 @@ class MultiHeadAttention(nn.Module):
                        diagonal=1)
         )
 
-    def forward(self, x):
+        # Key/value cache for incremental decoding (not part of the state_dict)
+        self.register_buffer("cache_k", None, persistent=False)
+        self.register_buffer("cache_v", None, persistent=False)
+        self.ptr_current_pos = 0
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved with separate Q/K/V projections (e.g. Fine_tuned_updrs_model.pth)
+        # load into the packed layout, and packed checkpoints load into the reference layout
+        names = [prefix + f"W_{part}." for part in ("query", "key", "value")]
+        for param in ("weight", "bias"):
+            if self.fused and names[0] + param in state_dict:
+                state_dict[prefix + "W_qkv." + param] = torch.cat(
+                    [state_dict.pop(name + param) for name in names], dim=0)
+            elif not self.fused and prefix + "W_qkv." + param in state_dict:
+                parts = state_dict.pop(prefix + "W_qkv." + param).chunk(3, dim=0)
+                for name, part in zip(names, parts):
+                    state_dict[name + param] = part
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, use_cache=False, pad_lengths=None):
         b, num_tokens, d_in = x.shape
 
-        keys = self.W_key(x) # Shape: (b, num_tokens, d_out)
-        queries = self.W_query(x)
-        values = self.W_value(x)
-
-        # We implicitly split the matrix by adding a `num_heads` dimension
-        # Unroll last dim: (b, num_tokens, d_out) -> (b, num_tokens, num_heads, head_dim)
-        keys = keys.view(b, num_tokens, self.num_heads, self.head_dim)
-        values = values.view(b, num_tokens, self.num_heads, self.head_dim)
-        queries = queries.view(b, num_tokens, self.num_heads, self.head_dim)
+        if self.fused:
+            # One matmul for all three projections: (b, num_tokens, 3 * d_out)
+            # -> (3, b, num_heads, num_tokens, head_dim)
+            qkv = self.W_qkv(x).view(b, num_tokens, 3, self.num_heads, self.head_dim)
+            queries, keys, values = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+        else:
+            keys = self.W_key(x) # Shape: (b, num_tokens, d_out)
+            queries = self.W_query(x)
+            values = self.W_value(x)
+
+            # We implicitly split the matrix by adding a `num_heads` dimension
+            # Unroll last dim: (b, num_tokens, d_out) -> (b, num_tokens, num_heads, head_dim)
+            keys = keys.view(b, num_tokens, self.num_heads, self.head_dim)
+            values = values.view(b, num_tokens, self.num_heads, self.head_dim)
+            queries = queries.view(b, num_tokens, self.num_heads, self.head_dim)
+
+            # Transpose: (b, num_tokens, num_heads, head_dim) -> (b, num_heads, num_tokens, head_dim)
+            keys = keys.transpose(1, 2)
+            queries = queries.transpose(1, 2)
+            values = values.transpose(1, 2)
+
+        # With the cache enabled, append the new keys/values to the ones from earlier steps
+        if use_cache:
+            if self.cache_k is None:
+                self.cache_k, self.cache_v = keys, values
+            else:
+                self.cache_k = torch.cat([self.cache_k, keys], dim=2)
+                self.cache_v = torch.cat([self.cache_v, values], dim=2)
+            keys, values = self.cache_k, self.cache_v
+
+        # The query rows start at the current cache position when decoding incrementally
+        num_tokens_k = keys.shape[2]
+        if use_cache:
+            start = self.ptr_current_pos
+            self.ptr_current_pos += num_tokens
+        else:
+            start = 0
 
-        # Transpose: (b, num_tokens, num_heads, head_dim) -> (b, num_heads, num_tokens, head_dim)
-        keys = keys.transpose(1, 2)
-        queries = queries.transpose(1, 2)
-        values = values.transpose(1, 2)
+        if self.fused:
+            context_vec = self._fused_attention(queries, keys, values, start, pad_lengths)
+        else:
+            # Compute scaled dot-product attention (aka self-attention) with a causal mask
+            attn_scores = queries @ keys.transpose(2, 3)  # Dot product for each head
 
-        # Compute scaled dot-product attention (aka self-attention) with a causal mask
-        attn_scores = queries @ keys.transpose(2, 3)  # Dot product for each head
+            # Original mask truncated to the number of tokens and converted to boolean
+            if pad_lengths is None:
+                mask_bool = self.mask[start:start + num_tokens, :num_tokens_k].bool()
+            else:
+                mask_bool = ~self._padded_attention_mask(start, num_tokens, num_tokens_k, pad_lengths)
 
-        # Original mask truncated to the number of tokens and converted to boolean
-        mask_bool = self.mask.bool()[:num_tokens, :num_tokens]
+            # Use the mask to fill attention scores
+            attn_scores.masked_fill_(mask_bool, -torch.inf)
 
-        # Use the mask to fill attention scores
-        attn_scores.masked_fill_(mask_bool, -torch.inf)
+            attn_weights = torch.softmax(attn_scores / keys.shape[-1]**0.5, dim=-1)
+            attn_weights = self.dropout(attn_weights)
 
-        attn_weights = torch.softmax(attn_scores / keys.shape[-1]**0.5, dim=-1)
-        attn_weights = self.dropout(attn_weights)
+            context_vec = attn_weights @ values
 
         # Shape: (b, num_tokens, num_heads, head_dim)
-        context_vec = (attn_weights @ values).transpose(1, 2)
+        context_vec = context_vec.transpose(1, 2)
 
         # Combine heads, where self.d_out = self.num_heads * self.head_dim
         context_vec = context_vec.contiguous().view(b, num_tokens, self.d_out)
@@ -98,6 +179,43 @@ class MultiHeadAttention(nn.Module):
 
         return context_vec
 
+    def _fused_attention(self, queries, keys, values, start, pad_lengths=None):
+        num_tokens, num_tokens_k = queries.shape[2], keys.shape[2]
+        dropout_p = self.dropout.p if self.training else 0.0
+
+        if pad_lengths is not None:
+            allowed = self._padded_attention_mask(start, num_tokens, num_tokens_k, pad_lengths)
+            return nn.functional.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=allowed, dropout_p=dropout_p)
+
+        # Full causal block (no cache, or prefill into an empty cache): let the kernel build the mask.
+        # A single new token attends to every cached key, so no mask is needed at all.
+        # Only a multi-token chunk appended to a non-empty cache needs an explicit mask.
+        if num_tokens == num_tokens_k:
+            return nn.functional.scaled_dot_product_attention(
+                queries, keys, values, dropout_p=dropout_p, is_causal=True)
+        if num_tokens == 1:
+            return nn.functional.scaled_dot_product_attention(
+                queries, keys, values, dropout_p=dropout_p)
+        allowed = self.mask[start:start + num_tokens, :num_tokens_k] == 0
+        return nn.functional.scaled_dot_product_attention(
+            queries, keys, values, attn_mask=allowed, dropout_p=dropout_p)
+
+    def _padded_attention_mask(self, start, num_tokens, num_tokens_k, pad_lengths):
+        # Causal mask for a left-padded batch, shape (b, 1, num_tokens, num_tokens_k), True = attend.
+        # Real tokens never attend to the padding; padding tokens attend only to themselves
+        # so their rows stay finite (a fully masked row would turn into NaNs).
+        q_pos = torch.arange(start, start + num_tokens, device=pad_lengths.device)
+        k_pos = torch.arange(num_tokens_k, device=pad_lengths.device)
+        causal = k_pos[None, :] <= q_pos[:, None]
+        not_pad = k_pos[None, :] >= pad_lengths[:, None]
+        allowed = causal[None] & (not_pad[:, None, :] | (k_pos[None, :] == q_pos[:, None])[None])
+        return allowed[:, None]
+
+    def reset_cache(self):
+        self.cache_k, self.cache_v = None, None
+        self.ptr_current_pos = 0
+
 
 class TransformerBlock(nn.Module):
     def __init__(self, cfg):
@@ -108,17 +226,18 @@ class TransformerBlock(nn.Module):
             context_length=cfg["context_length"],
             num_heads=cfg["n_heads"],
             dropout=cfg["drop_rate"],
-            qkv_bias=cfg["qkv_bias"])
+            qkv_bias=cfg["qkv_bias"],
+            fused=cfg.get("fused_attn", False))
         self.ff = FeedForward(cfg)
-        self.norm1 = LayerNorm(cfg["emb_dim"])
-        self.norm2 = LayerNorm(cfg["emb_dim"])
+        self.norm1 = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_kernels", False))
+        self.norm2 = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_kernels", False))
         self.drop_shortcut = nn.Dropout(cfg["drop_rate"])
 
-    def forward(self, x):
+    def forward(self, x, use_cache=False, pad_lengths=None):
         # Shortcut connection for attention block
         shortcut = x
         x = self.norm1(x)
-        x = self.att(x)  # Shape [batch_size, num_tokens, emb_size]
+        x = self.att(x, use_cache=use_cache, pad_lengths=pad_lengths)  # Shape [batch_size, num_tokens, emb_size]
         x = self.drop_shortcut(x)
         x = x + shortcut  # Add the original input back
 
@@ -145,44 +264,137 @@ class MultiHeadAttentionWrapper(nn.Module):
     def forward(self, x):
         return torch.cat([head(x) for head in self.heads], dim=-1)
 
-import os
-import urllib.request
 
-file_path = "the-verdict.txt"
-url = "https://raw.githubusercontent.com/rasbt/LLMs-from-scratch/main/ch02/01_main-chapter-code/the-verdict.txt"
+VERDICT_URL = "https://raw.githubusercontent.com/rasbt/LLMs-from-scratch/main/ch02/01_main-chapter-code/the-verdict.txt"
 
-if not os.path.exists(file_path):
-    with urllib.request.urlopen(url) as response:
-        text_data = response.read().decode('utf-8')
-    with open(file_path, "w", encoding="utf-8") as file:
-        file.write(text_data)
-else:
-    with open(file_path, "r", encoding="utf-8") as file:
-        text_data = file.read()
 
-##############################
-# First 100 characters
-print(text_data[:99])
-
-# Last 100 characters
-print(text_data[-99:])
-
-############################
-import tiktoken
-
-tokenizer = tiktoken.get_encoding("gpt2")
-
-total_characters = len(text_data)
-total_tokens = len(tokenizer.encode(text_data))
-
-print("Characters:", total_characters)
-print("Tokens:", total_tokens)
+def load_verdict_text(file_path="the-verdict.txt", url=VERDICT_URL):
+    if not os.path.exists(file_path):
+        with urllib.request.urlopen(url) as response:
+            text_data = response.read().decode('utf-8')
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write(text_data)
+    else:
+        with open(file_path, "r", encoding="utf-8") as file:
+            text_data = file.read()
+    return text_data
 
 
 ##############################
-
-
-from torch.utils.data import Dataset, DataLoader
+ENDOFTEXT = frozenset({"<|endoftext|>"})
+
+
+class TokenizerService:
+    # One shared tiktoken encoding for the process (see get_tokenizer), usable wherever a tiktoken
+    # tokenizer is expected. Encodings of short texts (prompts, instruction templates) are kept in
+    # an LRU cache, batches are encoded/decoded on tiktoken's thread pool, and encode_to_tensor
+    # writes a left-padded batch straight into one preallocated int64 array.
+    # "<|endoftext|>" is always allowed, as in the rest of this file.
+    def __init__(self, encoding_name="gpt2", cache_size=4096, max_cached_chars=2048, num_threads=8):
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.cache_size = cache_size
+        self.max_cached_chars = max_cached_chars  # Whole books and corpus chunks are not worth caching
+        self.num_threads = num_threads
+        self.cache = OrderedDict()  # (text, allowed_special) -> token ids (tuple)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def n_vocab(self):
+        return self.encoding.n_vocab
+
+    @property
+    def eot_token(self):
+        return self.encoding.eot_token
+
+    def _cached(self, key):
+        with self.lock:
+            token_ids = self.cache.get(key)
+            if token_ids is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return token_ids
+
+    def _remember(self, key, token_ids):
+        with self.lock:
+            self.cache[key] = tuple(token_ids)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def encode(self, text, allowed_special=ENDOFTEXT):
+        if len(text) > self.max_cached_chars or self.cache_size == 0:
+            return self.encoding.encode(text, allowed_special=allowed_special)
+        key = (text, frozenset(allowed_special))
+        token_ids = self._cached(key)
+        if token_ids is None:
+            token_ids = self.encoding.encode(text, allowed_special=allowed_special)
+            self._remember(key, token_ids)
+        return list(token_ids)
+
+    def encode_batch(self, texts, allowed_special=ENDOFTEXT):
+        # Cache hits are looked up, the distinct misses are encoded together on tiktoken's threads
+        allowed = frozenset(allowed_special)
+        results = [None] * len(texts)
+        missing = {}  # text -> positions in texts
+        for i, text in enumerate(texts):
+            if text in missing:
+                missing[text].append(i)
+                continue
+            token_ids = self._cached((text, allowed)) if len(text) <= self.max_cached_chars else None
+            if token_ids is None:
+                missing[text] = [i]
+            else:
+                results[i] = list(token_ids)
+        if missing:
+            encoded = self.encoding.encode_batch(list(missing), num_threads=self.num_threads,
+                                                 allowed_special=allowed_special)
+            for (text, positions), token_ids in zip(missing.items(), encoded):
+                for i in positions:
+                    results[i] = list(token_ids)
+                if len(text) <= self.max_cached_chars and self.cache_size:
+                    self._remember((text, allowed), token_ids)
+        return results
+
+    def encode_to_tensor(self, texts, pad_id=50256, device=None):
+        # Left-padded (len(texts), max_len) token tensor and the number of padding columns per row,
+        # the layout generate_batch and the batch scheduler use
+        encoded = self.encode_batch(texts)
+        max_len = max(len(token_ids) for token_ids in encoded)
+        out = np.full((len(encoded), max_len), pad_id, dtype=np.int64)
+        for row, token_ids in enumerate(encoded):
+            if token_ids:
+                out[row, max_len - len(token_ids):] = token_ids
+        pad_lengths = torch.tensor([max_len - len(token_ids) for token_ids in encoded], device=device)
+        return torch.from_numpy(out).to(device), pad_lengths
+
+    def decode(self, token_ids):
+        return self.encoding.decode(token_ids)
+
+    def decode_batch(self, batch):
+        return self.encoding.decode_batch(batch, num_threads=self.num_threads)
+
+    def decode_single_token_bytes(self, token_id):
+        return self.encoding.decode_single_token_bytes(token_id)
+
+    def cache_info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache), "max_size": self.cache_size}
+
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(encoding_name="gpt2"):
+    # The process-wide TokenizerService for this encoding (created on first use)
+    with _tokenizers_lock:
+        if encoding_name not in _tokenizers:
+            _tokenizers[encoding_name] = TokenizerService(encoding_name)
+        return _tokenizers[encoding_name]
 
 
 class GPTDatasetV1(Dataset):
@@ -211,8 +423,8 @@ def create_dataloader_v1(txt, batch_size=4, max_length=256,
                          stride=128, shuffle=True, drop_last=True,
                          num_workers=0):
 
-    # Initialize the tokenizer
-    tokenizer = tiktoken.get_encoding("gpt2")
+    # Shared tokenizer instead of a new encoding per call
+    tokenizer = get_tokenizer()
 
     # Create dataset
     dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
@@ -228,6 +440,83 @@ def create_dataloader_v1(txt, batch_size=4, max_length=256,
 
     return dataloader
 
+
+def tokenize_to_memmap(txt_paths, out_path, tokenizer=None, chunk_lines=10000):
+    # Tokenizes text files once into a flat uint16 token file (GPT-2 ids < 65536).
+    # Files are streamed in chunks of lines, so the corpus never has to fit in RAM.
+    tokenizer = tokenizer or get_tokenizer()
+    tmp_path = out_path + ".tmp"
+    num_tokens = 0
+    with open(tmp_path, "wb") as out_file:
+        for txt_path in txt_paths:
+            with open(txt_path, "r", encoding="utf-8") as file:
+                lines = []
+                for line in file:
+                    lines.append(line)
+                    if len(lines) == chunk_lines:
+                        num_tokens += _write_token_chunk(out_file, "".join(lines), tokenizer)
+                        lines = []
+                if lines:
+                    num_tokens += _write_token_chunk(out_file, "".join(lines), tokenizer)
+    os.replace(tmp_path, out_path)
+    return num_tokens
+
+
+def _write_token_chunk(out_file, text, tokenizer):
+    token_ids = tokenizer.encode(text, allowed_special={"<|endoftext|>"})
+    np.asarray(token_ids, dtype=np.uint16).tofile(out_file)
+    return len(token_ids)
+
+
+class GPTDatasetMemmap(Dataset):
+    # Same sliding windows as GPTDatasetV1, served from a pre-tokenized uint16 .bin file.
+    # Only the window being read is ever materialized, and input/target share one buffer.
+    def __init__(self, bin_path, max_length, stride):
+        self.bin_path = bin_path
+        self.max_length = max_length
+        self.stride = stride
+        num_tokens = os.path.getsize(bin_path) // np.dtype(np.uint16).itemsize
+        self.num_windows = len(range(0, num_tokens - max_length, stride))
+        self._tokens = None
+
+    def _token_array(self):
+        # Opened lazily so every DataLoader worker maps the file itself
+        if self._tokens is None:
+            self._tokens = np.memmap(self.bin_path, dtype=np.uint16, mode="r")
+        return self._tokens
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = None  # Memmaps are not sent to worker processes
+        return state
+
+    def __len__(self):
+        return self.num_windows
+
+    def __getitem__(self, idx):
+        start = idx * self.stride
+        window = self._token_array()[start:start + self.max_length + 1]
+        window = torch.from_numpy(window.astype(np.int64))
+        return window[:-1], window[1:]
+
+
+def create_dataloader_memmap(bin_path, batch_size=4, max_length=256,
+                             stride=128, shuffle=True, drop_last=True,
+                             num_workers=0):
+
+    dataset = GPTDatasetMemmap(bin_path, max_length, stride)
+
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0
+    )
+
+    return dataloader
+
 #################################
 
 
@@ -242,81 +531,6 @@ GPT_CONFIG_124M = {
 }
 
 
-
-# Train/validation ratio
-train_ratio = 0.90
-split_idx = int(train_ratio * len(text_data))
-train_data = text_data[:split_idx]
-val_data = text_data[split_idx:]
-
-import torch
-import torch.nn as nn
-
-
-
-torch.manual_seed(123)
-
-train_loader = create_dataloader_v1(
-    train_data,
-    batch_size=2,
-    max_length=GPT_CONFIG_124M["context_length"],
-    stride=GPT_CONFIG_124M["context_length"],
-    drop_last=True,
-    shuffle=True,
-    num_workers=0
-)
-
-val_loader = create_dataloader_v1(
-    val_data,
-    batch_size=2,
-    max_length=GPT_CONFIG_124M["context_length"],
-    stride=GPT_CONFIG_124M["context_length"],
-    drop_last=False,
-    shuffle=False,
-    num_workers=0
-)
-
-###############################
-
-# Sanity check
-
-if total_tokens * (train_ratio) < GPT_CONFIG_124M["context_length"]:
-    print("Not enough tokens for the training loader. "
-          "Try to lower the `GPT_CONFIG_124M['context_length']` or "
-          "increase the `training_ratio`")
-
-if total_tokens * (1-train_ratio) < GPT_CONFIG_124M["context_length"]:
-    print("Not enough tokens for the validation loader. "
-          "Try to lower the `GPT_CONFIG_124M['context_length']` or "
-          "decrease the `training_ratio`")
-
-###################################
-
-print("Train loader:")
-for x, y in train_loader:
-    print(x.shape, y.shape)
-
-print("\nValidation loader:")
-for x, y in val_loader:
-    print(x.shape, y.shape)
-
-print(len(train_loader))
-print(len(val_loader))
-
-##################################
-
-train_tokens = 0
-for input_batch, target_batch in train_loader:
-    train_tokens += input_batch.numel()
-
-val_tokens = 0
-for input_batch, target_batch in val_loader:
-    val_tokens += input_batch.numel()
-
-print("Training tokens:", train_tokens)
-print("Validation tokens:", val_tokens)
-print("All tokens:", train_tokens + val_tokens)
-
 #####################################
 
 class GPTModel(nn.Module):
@@ -326,50 +540,111 @@ class GPTModel(nn.Module):
         self.pos_emb = nn.Embedding(cfg["context_length"], cfg["emb_dim"])
         self.drop_emb = nn.Dropout(cfg["drop_rate"])
 
-        self.trf_blocks = nn.Sequential(
-            *[TransformerBlock(cfg) for _ in range(cfg["n_layers"])])
+        # ModuleList (not Sequential) so `use_cache` can be passed to every block;
+        # the state_dict keys (trf_blocks.0, trf_blocks.1, ...) are unchanged
+        self.trf_blocks = nn.ModuleList(
+            [TransformerBlock(cfg) for _ in range(cfg["n_layers"])])
 
-        self.final_norm = LayerNorm(cfg["emb_dim"])
+        self.final_norm = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_kernels", False))
         self.out_head = nn.Linear(
             cfg["emb_dim"], cfg["vocab_size"], bias=False
         )
-
-    def forward(self, in_idx):
+        # tie_weights=True: out_head reuses the token embedding matrix, as in the original GPT-2
+        # (one 50257x768 matrix less). Both keys stay in the state_dict, sharing one tensor.
+        if cfg.get("tie_weights", False):
+            self.out_head.weight = self.tok_emb.weight
+        self.current_pos = 0  # Number of tokens already held in the KV cache
+        self.gradient_checkpointing = False  # Recompute block activations in backward (training only)
+
+    def forward(self, in_idx, use_cache=False, pad_lengths=None, output_positions=None):
+        # output_positions: index into the sequence dimension (e.g. LAST_POSITION) to compute the
+        # final norm and the vocabulary projection only there; the cache still gets every position
         batch_size, seq_len = in_idx.shape
         tok_embeds = self.tok_emb(in_idx)
-        pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+
+        # Cached tokens keep their absolute positions across decoding steps
+        if use_cache:
+            pos_ids = torch.arange(self.current_pos, self.current_pos + seq_len, device=in_idx.device)
+            self.current_pos += seq_len
+        else:
+            pos_ids = torch.arange(seq_len, device=in_idx.device)
+
+        # Left-padded batches: every row's first real token gets position 0
+        if pad_lengths is not None:
+            pos_ids = (pos_ids[None, :] - pad_lengths[:, None]).clamp(min=0)
+        pos_embeds = self.pos_emb(pos_ids)
+
         x = tok_embeds + pos_embeds  # Shape [batch_size, num_tokens, emb_size]
         x = self.drop_emb(x)
-        x = self.trf_blocks(x)
+        for block in self.trf_blocks:
+            if self.gradient_checkpointing and self.training and not use_cache:
+                # Store only the block input; its activations are recomputed in the backward pass
+                x = torch.utils.checkpoint.checkpoint(block, x, use_reentrant=False, pad_lengths=pad_lengths)
+            else:
+                x = block(x, use_cache=use_cache, pad_lengths=pad_lengths)
+        if output_positions is not None:
+            x = x[:, output_positions]
         x = self.final_norm(x)
         logits = self.out_head(x)
         return logits
 
-torch.manual_seed(123)
-model = GPTModel(GPT_CONFIG_124M)
-model.eval();  # Disable dropout during inference
+    def reset_kv_cache(self):
+        for block in self.trf_blocks:
+            block.att.reset_cache()
+        self.current_pos = 0
 
-###################################
+    def get_kv_cache(self):
+        # Per-block (keys, values) and the number of cached positions, so a scheduler can
+        # set a running batch aside, prefill other sequences and merge the two caches
+        return [(block.att.cache_k, block.att.cache_v) for block in self.trf_blocks], self.current_pos
 
+    def set_kv_cache(self, cache, current_pos):
+        for block, (keys, values) in zip(self.trf_blocks, cache):
+            block.att.cache_k, block.att.cache_v = keys, values
+            block.att.ptr_current_pos = current_pos
+        self.current_pos = current_pos
 
+    def trim_kv_cache(self, num_tokens):
+        # Forget every cached position from num_tokens on (e.g. rejected speculative tokens)
+        if num_tokens >= self.current_pos:
+            return
+        cache, _ = self.get_kv_cache()
+        self.set_kv_cache([(keys[:, :, :num_tokens], values[:, :, :num_tokens]) for keys, values in cache],
+                          num_tokens)
 
 
+LAST_POSITION = slice(-1, None)  # output_positions for next-token logits: shape (batch_size, 1, vocab_size)
 
 
-import tensorflow as tf
-import tqdm
+def tie_output_head(gpt):
+    # Makes out_head share tok_emb's matrix when both hold the same values (GPT-2 weights, a model
+    # fine-tuned with tie_weights), so the outputs do not change. Returns whether they are tied.
+    if not isinstance(gpt.out_head, nn.Linear):
+        return False  # Quantized output head
+    if gpt.out_head.weight is gpt.tok_emb.weight:
+        return True
+    if not torch.equal(gpt.out_head.weight, gpt.tok_emb.weight):
+        return False
+    gpt.out_head.weight = gpt.tok_emb.weight
+    return True
 
-print("TensorFlow version:", tf.__version__)
-print("tqdm version:", tqdm.__version__)
-############################################################################################
-import os
-import requests  # Make sure requests is installed
-import json
-import numpy as np
-import tensorflow as tf
-from tqdm import tqdm
 
-def download_and_load_gpt2(model_size, models_dir):
+############################################################################################
+GPT2_BASE_URL = "https://openaipublic.blob.core.windows.net/gpt-2/models"
+GPT2_FILENAMES = [
+    "checkpoint", "encoder.json", "hparams.json",
+    "model.ckpt.data-00000-of-00001", "model.ckpt.index",
+    "model.ckpt.meta", "vocab.bpe"
+]
+GPT2_CHECKSUMS_FILENAME = "SHA256SUMS"  # sha256sum format, next to the downloaded files
+
+def download_and_load_gpt2(model_size, models_dir, base_url=GPT2_BASE_URL, offline=False,
+                           checksums=None, max_workers=4):
+    # offline=True never touches the network: every file must already be in models_dir.
+    # checksums: {filename: sha256} used to verify cached and downloaded files. By default this is
+    # trust on first use, not checksum verification: nothing is pinned, the digests of whatever
+    # the first download received are recorded in SHA256SUMS, and later loads must match them.
+    # Pass the published digests to actually verify a download.
     # Validate model size
     allowed_sizes = ("124M", "355M", "774M", "1558M")
     if model_size not in allowed_sizes:
@@ -377,62 +652,168 @@ def download_and_load_gpt2(model_size, models_dir):
 
     # Define paths
     model_dir = os.path.join(models_dir, model_size)
-    base_url = "https://openaipublic.blob.core.windows.net/gpt-2/models"
-    filenames = [
-        "checkpoint", "encoder.json", "hparams.json",
-        "model.ckpt.data-00000-of-00001", "model.ckpt.index",
-        "model.ckpt.meta", "vocab.bpe"
-    ]
+    checksums_path = os.path.join(model_dir, GPT2_CHECKSUMS_FILENAME)
+    if checksums is None:
+        checksums = read_checksums(checksums_path)
 
-    # Download files
+    # Download files (concurrently; files already in the cache are skipped)
     os.makedirs(model_dir, exist_ok=True)
-    for filename in filenames:
-        file_url = os.path.join(base_url, model_size, filename)
-        file_path = os.path.join(model_dir, filename)
-        download_file(file_url, file_path)
+    downloads = [
+        (f"{base_url}/{model_size}/{filename}", os.path.join(model_dir, filename), checksums.get(filename))
+        for filename in GPT2_FILENAMES
+    ]
+    download_files(downloads, offline=offline, max_workers=max_workers)
+
+    # Trust on first use: record the digests of a first download, so later loads detect files
+    # that changed or were corrupted since (not a tampered or wrong first download)
+    if any(filename not in checksums for filename in GPT2_FILENAMES):
+        recorded = {filename: cached_file_sha256(os.path.join(model_dir, filename)) for filename in GPT2_FILENAMES}
+        write_checksums(checksums_path, dict(recorded, **checksums))
 
     ## We have reached here until now ---> we have downloaded the files on our local machine.
 
     # Load settings and params
+    import tensorflow as tf  # Lazy import, see note at the top of the module
     tf_ckpt_path = tf.train.latest_checkpoint(model_dir)
     settings = json.load(open(os.path.join(model_dir, "hparams.json")))
     params = load_gpt2_params_from_tf_ckpt(tf_ckpt_path, settings)
 
     return settings, params
 
-def download_file(url, destination):
-    try:
-        # Send a GET request to download the file, disabling SSL verification
-        response = requests.get(url, stream=True, verify=False)
-
-        # Get the total file size from headers, defaulting to 0 if not present
-        file_size = int(response.headers.get("content-length", 0))
-
-        # Check if file exists and has the same size
+def download_files(downloads, offline=False, max_workers=4):
+    # downloads: list of (url, destination, expected_sha256 or None), fetched concurrently.
+    # The first failure is raised once all downloads have finished.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_file, url, destination, expected_sha256, offline, position)
+            for position, (url, destination, expected_sha256) in enumerate(downloads)
+        ]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise errors[0]
+
+def download_file(url, destination, expected_sha256=None, offline=False, progress_position=None,
+                  chunk_size=1 << 20, retries=3, timeout=60):
+    # Streams into `destination + ".part"` and renames it once complete and verified, so
+    # `destination` only ever exists as a complete file. An interrupted download is resumed
+    # from the .part file with an HTTP Range request.
+    with requests.Session() as session:
         if os.path.exists(destination):
-            file_size_local = os.path.getsize(destination)
-            if file_size == file_size_local:
-                print(f"File already exists and is up-to-date: {destination}")
-                return
-
-        # Define the block size for reading the file
-        block_size = 1024  # 1 Kilobyte
+            if _is_cached_file_valid(session, url, destination, expected_sha256, offline, timeout):
+                return destination
+            os.remove(destination)
+
+        if offline:
+            raise FileNotFoundError(f"{destination} is not in the local cache and offline mode is on")
+
+        part_path = destination + ".part"
+        for attempt in range(retries):
+            try:
+                complete = _download_part(session, url, part_path, chunk_size, progress_position, timeout)
+            except requests.exceptions.RequestException:
+                if attempt == retries - 1:
+                    raise
+                continue
+            if complete:
+                break
+        else:
+            raise IOError(f"Download of {url} stopped early {retries} times")
+
+    if expected_sha256 is not None and file_sha256(part_path) != expected_sha256:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for {url}")
+    os.replace(part_path, destination)
+    return destination
+
+def _is_cached_file_valid(session, url, destination, expected_sha256, offline, timeout):
+    if expected_sha256 is not None:
+        return cached_file_sha256(destination) == expected_sha256
+    if offline:
+        return True
+    # Without a checksum compare sizes; a HEAD request avoids starting the download
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    file_size = int(response.headers.get("content-length", 0))
+    return file_size == 0 or file_size == os.path.getsize(destination)
+
+def _download_part(session, url, part_path, chunk_size, progress_position, timeout):
+    # Returns True when the .part file holds the complete file
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as response:
+        if response.status_code == 416:
+            # Range not satisfiable: the .part file already holds the whole file
+            return True
+        response.raise_for_status()
+        if response.status_code != 206:
+            resume_from = 0  # The server ignored the Range header: start over
+        file_size = resume_from + int(response.headers.get("content-length", 0))
 
         # Initialize the progress bar with total file size
         progress_bar_description = url.split("/")[-1]  # Extract filename from URL
-        with tqdm(total=file_size, unit="iB", unit_scale=True, desc=progress_bar_description) as progress_bar:
-            # Open the destination file in binary write mode
-            with open(destination, "wb") as file:
-                # Iterate over the file data in chunks
-                for chunk in response.iter_content(block_size):
-                    progress_bar.update(len(chunk))  # Update progress bar
-                    file.write(chunk)  # Write the chunk to the file
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading the file: {e}")
-        print(f"Please check the URL: {url}")
+        with tqdm(total=file_size, initial=resume_from, unit="iB", unit_scale=True,
+                  desc=progress_bar_description, position=progress_position) as progress_bar:
+            with open(part_path, "ab" if resume_from else "wb") as file:
+                for chunk in response.iter_content(chunk_size):
+                    progress_bar.update(len(chunk))
+                    file.write(chunk)
+
+    return file_size == resume_from or os.path.getsize(part_path) == file_size
+
+def file_sha256(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(block_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cached_file_sha256(path):
+    # Hashing a 500 MB checkpoint takes seconds, so the digest is kept next to the file
+    # and reused for as long as its size and modification time are unchanged
+    stat = os.stat(path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    cache_path = path + ".sha256"
+    try:
+        with open(cache_path, "r", encoding="utf-8") as file:
+            cached = json.load(file)
+        if cached["source"] == source:
+            return cached["sha256"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    digest = file_sha256(path)
+    # Best effort: a read-only checkout just hashes every time
+    try:
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"source": source, "sha256": digest}, file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return digest
+
+def read_checksums(path):
+    # {filename: sha256} from a sha256sum-style file; empty when there is none
+    if not os.path.exists(path):
+        return {}
+    checksums = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                digest, name = line.split(None, 1)
+                checksums[name.strip().lstrip("*")] = digest  # "*name" marks binary mode
+    return checksums
+
+def write_checksums(path, checksums):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        for name, digest in sorted(checksums.items()):
+            file.write(f"{digest}  {name}\n")
+    os.replace(tmp_path, path)
 
 def load_gpt2_params_from_tf_ckpt(ckpt_path, settings):
+    import tensorflow as tf  # Lazy import, see note at the top of the module
     # Initialize parameters dictionary with empty blocks for each layer
     params = {"blocks": [{} for _ in range(settings["n_layer"])]}
 
@@ -460,66 +841,411 @@ def load_gpt2_params_from_tf_ckpt(ckpt_path, settings):
 
     return params
 
-##################################################################################################
-def generate(model, idx, max_new_tokens, context_size, temperature=0.0, top_k=None, eos_id=None):
-
-    # For-loop is the same as before: Get logits, and only focus on last time step
-    for _ in range(max_new_tokens):
-        idx_cond = idx[:, -context_size:]
-        with torch.no_grad():
-            logits = model(idx_cond)
-        logits = logits[:, -1, :]
-
-        # New: Filter logits with top_k sampling
-        if top_k is not None:
-            # Keep only top_k values
-            top_logits, _ = torch.topk(logits, top_k)
-            min_val = top_logits[:, -1]
-            logits = torch.where(logits < min_val, torch.tensor(float("-inf")).to(logits.device), logits)
-
-        # New: Apply temperature scaling
-        if temperature > 0.0:
-            logits = logits / temperature
-
-            # Apply softmax to get probabilities
-            probs = torch.softmax(logits, dim=-1)  # (batch_size, context_len)
 
-            # Sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)  # (batch_size, 1)
-
-        # Otherwise same as before: get idx of the vocab entry with the highest logits value
+##################################################################################################
+def next_token_logits(model, idx, context_size, use_cache, step, prefix_cache=None):
+    # Prefill the whole prompt once, then feed only the newest token through the KV cache.
+    # Once the sequence outgrows the context window every position shifts, so fall back
+    # to a full forward pass over the cropped window (same as the uncached path).
+    with torch.no_grad():
+        if use_cache and idx.shape[1] <= context_size:
+            if step == 0:
+                return prefill(model, idx, prefix_cache=prefix_cache)
+            logits = model(idx[:, -1:], use_cache=True)
+        else:
+            logits = model(idx[:, -context_size:], output_positions=LAST_POSITION)
+    return logits[:, -1, :]
+
+
+class PrefixKVCache:
+    # Keys/values of prompt prefixes, reused across requests and batches (one cache per model).
+    # Prompts are cut into blocks of block_size tokens. A block is keyed by the hash of every token
+    # from the start of the prompt to the block's end and holds that block's keys/values for every
+    # layer, so a new prompt reuses the longest run of cached blocks it starts with: requests that
+    # share the instruction preamble only prefill the part that follows it.
+    # Least recently used blocks are evicted once the cache holds more than max_bytes.
+    def __init__(self, max_bytes=64 * 2**20, block_size=4):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = OrderedDict()  # prefix hash -> (block tokens, [(keys, values)] per layer, nbytes)
+        self.nbytes = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+        self.lock = threading.Lock()
+
+    def _block_keys(self, tokens):
+        # Hash of tokens[:end] for the end of every full block
+        digest = hashlib.sha256()
+        keys = []
+        for end in range(self.block_size, len(tokens) + 1, self.block_size):
+            digest.update(np.asarray(tokens[end - self.block_size:end], dtype=np.int64).tobytes())
+            keys.append(digest.copy().digest())
+        return keys
+
+    def lookup(self, tokens, max_tokens):
+        # Per-layer (keys, values) of shape (1, num_heads, n, head_dim) for the longest cached prefix
+        # of tokens with n <= max_tokens, and n; (None, 0) when not even the first block is cached
+        found = []
+        with self.lock:
+            for i, key in enumerate(self._block_keys(tokens[:max_tokens])):
+                block = self.blocks.get(key)
+                if block is None or block[0] != tuple(tokens[i * self.block_size:(i + 1) * self.block_size]):
+                    break
+                found.append(key)
+            # Most recent last, and a block's prefix more recent than the block itself
+            # (it is useless without it, so it is evicted after it)
+            for key in reversed(found):
+                self.blocks.move_to_end(key)
+            layers = [self.blocks[key][1] for key in found]
+        if not layers:
+            return None, 0
+        cache = [(torch.cat([block[layer][0] for block in layers], dim=2),
+                  torch.cat([block[layer][1] for block in layers], dim=2))
+                 for layer in range(len(layers[0]))]
+        return cache, len(layers) * self.block_size
+
+    def store(self, tokens, cache, row=0, offset=0):
+        # Adds the missing full blocks of tokens, whose keys/values are row `row` of a model KV cache
+        # (per-layer (keys, values)) starting at column `offset` (its left padding)
+        keys = self._block_keys(tokens)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.blocks:
+                    continue
+                start = offset + i * self.block_size
+                block = [(keys[row:row + 1, :, start:start + self.block_size].clone(),
+                          values[row:row + 1, :, start:start + self.block_size].clone())
+                         for keys, values in cache]
+                nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in block)
+                self.blocks[key] = (tuple(tokens[i * self.block_size:(i + 1) * self.block_size]), block, nbytes)
+                self.nbytes += nbytes
+            # Same order as in lookup: the last blocks of the prompt are evicted first
+            for key in reversed(keys):
+                self.blocks.move_to_end(key)
+            while self.nbytes > self.max_bytes and self.blocks:
+                _, (_, _, nbytes) = self.blocks.popitem(last=False)
+                self.nbytes -= nbytes
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        total = self.reused_tokens + self.prefilled_tokens
+        return {"blocks": len(self.blocks), "bytes": self.nbytes, "reused_tokens": self.reused_tokens,
+                "prefilled_tokens": self.prefilled_tokens, "reuse_rate": self.reused_tokens / total if total else 0.0}
+
+
+def common_prefix_length(a, b):
+    return next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+
+
+def prefill(model, idx, pad_lengths=None, prefix_cache=None):
+    # Runs a (left-padded) prompt batch into an empty KV cache and returns the last position's logits.
+    # With a prefix_cache the longest cached prefix shared by every row is loaded instead of computed,
+    # and the prompt blocks it did not have yet are added to it.
+    model.reset_kv_cache()
+    if prefix_cache is None:
+        return model(idx, use_cache=True, pad_lengths=pad_lengths, output_positions=LAST_POSITION)[:, -1, :]
+
+    batch_size, num_tokens = idx.shape
+    pads = [0] * batch_size if pad_lengths is None else pad_lengths.tolist()
+    rows = [idx[row, pad:].tolist() for row, pad in enumerate(pads)]
+    # Only a prefix all rows share can be loaded, and at least one token per row is left to run
+    common = min(common_prefix_length(rows[0], tokens) for tokens in rows)
+    cached, n = prefix_cache.lookup(rows[0], min(common, min(len(tokens) for tokens in rows) - 1))
+
+    with torch.no_grad():
+        if n:
+            # Column `start` is the first one run through the model. Every row's cached columns
+            # hold its left padding (zeros, masked out) followed by the start of the cached prefix;
+            # rows with more padding recompute part of the prefix in the forward pass.
+            start = min(pads) + n
+            cache = []
+            for keys, values in cached:
+                batch_keys = keys.new_zeros((batch_size, keys.shape[1], start, keys.shape[3]))
+                batch_values = torch.zeros_like(batch_keys)
+                for row, pad in enumerate(pads):
+                    if start > pad:
+                        batch_keys[row, :, pad:start] = keys[0, :, :start - pad]
+                        batch_values[row, :, pad:start] = values[0, :, :start - pad]
+                cache.append((batch_keys, batch_values))
+            model.set_kv_cache(cache, start)
+            logits = model(idx[:, start:], use_cache=True, pad_lengths=pad_lengths,
+                           output_positions=LAST_POSITION)[:, -1, :]
         else:
-            idx_next = torch.argmax(logits, dim=-1, keepdim=True)  # (batch_size, 1)
+            logits = model(idx, use_cache=True, pad_lengths=pad_lengths, output_positions=LAST_POSITION)[:, -1, :]
+
+    model_cache, _ = model.get_kv_cache()
+    for row, (tokens, pad) in enumerate(zip(rows, pads)):
+        prefix_cache.store(tokens, model_cache, row, pad)
+    prefix_cache.reused_tokens += n * batch_size
+    prefix_cache.prefilled_tokens += sum(len(tokens) for tokens in rows) - n * batch_size
+    return logits
+
+
+def apply_repetition_penalty_(logits, token_ids, penalty):
+    # CTRL-style penalty on every token already in the sequence, in place:
+    # positive logits are divided by the penalty, negative ones multiplied
+    scores = logits.gather(1, token_ids)
+    scores = torch.where(scores > 0, scores / penalty, scores * penalty)
+    logits.scatter_(1, token_ids, scores)
+
+
+def top_k_filter_(logits, top_k):
+    # Keep only the top_k logits of every row (in place)
+    min_val = torch.topk(logits, top_k).values[:, -1:]
+    logits.masked_fill_(logits < min_val, float("-inf"))
+
+
+def top_p_filter_(logits, top_p):
+    # Nucleus filtering (in place): keep the smallest set of tokens whose probability mass reaches
+    # top_p. The token that crosses the threshold is kept, so every row keeps at least one token.
+    sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+    probs = torch.softmax(sorted_logits, dim=-1)
+    remove = probs.cumsum(dim=-1) - probs > top_p
+    logits.scatter_(1, sorted_idx, sorted_logits.masked_fill_(remove, float("-inf")))
+
+
+def select_next_token(logits, temperature=0.0, top_k=None, top_p=None, repetition_penalty=1.0,
+                      token_ids=None):
+    # logits: (batch_size, vocab_size), modified in place.
+    # temperature: a float, or a (batch_size,) tensor for per-row temperatures; rows with
+    # temperature 0 are decoded greedily. token_ids: the sequence so far (for the repetition penalty).
+    if repetition_penalty != 1.0 and token_ids is not None:
+        apply_repetition_penalty_(logits, token_ids, repetition_penalty)
+
+    per_row = torch.is_tensor(temperature)
+    if not per_row and temperature <= 0.0:
+        # Greedy: get idx of the vocab entry with the highest logits value (filters cannot change it)
+        return torch.argmax(logits, dim=-1, keepdim=True)  # (batch_size, 1)
+
+    greedy = torch.argmax(logits, dim=-1, keepdim=True) if per_row else None
+
+    # Apply temperature scaling (greedy rows are scaled by 1, their sample is discarded below)
+    if per_row:
+        temperature = temperature.to(logits.device, logits.dtype)[:, None]
+        logits.div_(torch.where(temperature > 0, temperature, torch.ones_like(temperature)))
+    else:
+        logits.div_(temperature)
+
+    if top_k is not None:
+        top_k_filter_(logits, top_k)
+    if top_p is not None and top_p < 1.0:
+        top_p_filter_(logits, top_p)
+
+    # Sample from the distribution
+    probs = torch.softmax(logits, dim=-1)  # (batch_size, vocab_size)
+    idx_next = torch.multinomial(probs, num_samples=1)  # (batch_size, 1)
+
+    if per_row:
+        idx_next = torch.where(temperature > 0, idx_next, greedy)
+    return idx_next
+
+
+def generate(model, idx, max_new_tokens, context_size, temperature=0.0, top_k=None, eos_id=None,
+             use_cache=True, top_p=None, repetition_penalty=1.0, draft_model=None, num_speculative=4,
+             prefix_cache=None):
+
+    # The output buffer is allocated once; every step writes one column into it
+    # instead of re-concatenating the whole sequence
+    batch_size, num_tokens = idx.shape
+    out = idx.new_empty((batch_size, num_tokens + max_new_tokens))
+    out[:, :num_tokens] = idx
+
+    # Greedy decoding with a draft model: same output, fewer forward passes of the model
+    if draft_model is not None and can_speculate(idx, max_new_tokens, context_size, temperature,
+                                                 use_cache, repetition_penalty):
+        for new_tokens, _, _ in speculative_decode(model, draft_model, idx, max_new_tokens, num_speculative,
+                                                   eos_id, prefix_cache):
+            out[:, num_tokens:num_tokens + new_tokens.shape[1]] = new_tokens
+            num_tokens += new_tokens.shape[1]
+        return out[:, :num_tokens]
 
-        if idx_next == eos_id:  # Stop generating early if end-of-sequence token is encountered and eos_id is specified
+    # For-loop is the same as before: Get logits, and only focus on last time step
+    for step in range(max_new_tokens):
+        logits = next_token_logits(model, out[:, :num_tokens], context_size, use_cache, step, prefix_cache)
+        idx_next = select_next_token(logits, temperature, top_k, top_p, repetition_penalty,
+                                     out[:, :num_tokens])
+
+        # Stop generating early if end-of-sequence token is encountered and eos_id is specified
+        # (for a batch, once every row produced it; use generate_batch for per-row stopping)
+        if eos_id is not None and (idx_next == eos_id).all():
             break
 
-        # Same as before: append sampled index to the running sequence
-        idx = torch.cat((idx, idx_next), dim=1)  # (batch_size, num_tokens+1)
-
-    return idx
-
-def generate_text_simple(model, idx, max_new_tokens, context_size):
+        # Append sampled index to the running sequence
+        out[:, num_tokens] = idx_next[:, 0]
+        num_tokens += 1
+
+    if use_cache:
+        model.reset_kv_cache()  # Release the cached keys/values
+    return out[:, :num_tokens]
+
+def generate_stream(model, idx, max_new_tokens, context_size, temperature=0.0, top_k=None, eos_id=None,
+                    use_cache=True, top_p=None, repetition_penalty=1.0, draft_model=None, num_speculative=4,
+                    prefix_cache=None):
+    # Same decoding loop as generate, but yields each new token id as soon as it is chosen
+    # (tensor of shape (batch_size, 1)); the prompt itself is never yielded
+    if draft_model is not None and can_speculate(idx, max_new_tokens, context_size, temperature,
+                                                 use_cache, repetition_penalty):
+        # Accepted tokens arrive in blocks, and are still yielded one at a time
+        for new_tokens, _, _ in speculative_decode(model, draft_model, idx, max_new_tokens, num_speculative,
+                                                   eos_id, prefix_cache):
+            yield from new_tokens.split(1, dim=1)
+        return
+
+    batch_size, num_tokens = idx.shape
+    out = idx.new_empty((batch_size, num_tokens + max_new_tokens))
+    out[:, :num_tokens] = idx
+    try:
+        for step in range(max_new_tokens):
+            logits = next_token_logits(model, out[:, :num_tokens], context_size, use_cache, step,
+                                       prefix_cache)
+            idx_next = select_next_token(logits, temperature, top_k, top_p, repetition_penalty,
+                                         out[:, :num_tokens])
+
+            if eos_id is not None and (idx_next == eos_id).all():
+                break
+
+            yield idx_next
+            out[:, num_tokens] = idx_next[:, 0]
+            num_tokens += 1
+    finally:
+        # Also runs when the consumer stops iterating early
+        if use_cache:
+            model.reset_kv_cache()
+
+
+def generate_batch(model, prompts, max_new_tokens, context_size, temperature=0.0, top_k=None,
+                   eos_id=None, pad_id=50256, top_p=None, repetition_penalty=1.0, prefix_cache=None):
+    # Batched generation for prompts of different lengths (lists of token ids).
+    # Prompts are left-padded so every row's next token sits in the last column; each row
+    # stops at its own EOS and the loop exits once every row has finished.
+    # temperature may be a (batch_size,) tensor to sample every row at its own temperature.
+    # Returns the generated token ids per prompt (without the prompt and the EOS).
+    device = next(model.parameters()).device
+    max_len = max(len(p) for p in prompts)
+    if max_len + max_new_tokens > context_size:
+        raise ValueError(f"Prompt length {max_len} + {max_new_tokens} new tokens exceeds "
+                         f"the context size {context_size}")
+
+    # One buffer for prompts and generated tokens. The padding columns repeat each row's first
+    # prompt token, so the repetition penalty only ever sees tokens that are in the sequence.
+    out = torch.full((len(prompts), max_len + max_new_tokens), pad_id, dtype=torch.long, device=device)
+    for row, prompt in enumerate(prompts):
+        out[row, max_len - len(prompt):max_len] = torch.tensor(prompt, dtype=torch.long, device=device)
+        out[row, :max_len - len(prompt)] = prompt[0]
+    pad_lengths = torch.tensor([max_len - len(p) for p in prompts], device=device)
+
+    finished = torch.zeros(len(prompts), dtype=torch.bool, device=device)
+    num_tokens = max_len
+    with torch.no_grad():
+        logits = prefill(model, out[:, :max_len], pad_lengths, prefix_cache)
+        for step in range(max_new_tokens):
+            idx_next = select_next_token(logits, temperature, top_k, top_p, repetition_penalty,
+                                         out[:, :num_tokens])  # (batch_size, 1)
+            if eos_id is not None:
+                finished |= idx_next.squeeze(1) == eos_id
+                idx_next = idx_next.masked_fill(finished[:, None], eos_id)
+            out[:, num_tokens] = idx_next[:, 0]
+            num_tokens += 1
+            if finished.all() or step == max_new_tokens - 1:
+                break
+            logits = model(idx_next, use_cache=True, pad_lengths=pad_lengths)[:, -1, :]
+    model.reset_kv_cache()
+
+    outputs = []
+    for row in out[:, max_len:num_tokens].tolist():
+        if eos_id is not None and eos_id in row:
+            row = row[:row.index(eos_id)]
+        outputs.append(row)
+    return outputs
+
+def can_speculate(idx, max_new_tokens, context_size, temperature=0.0, use_cache=True, repetition_penalty=1.0):
+    # Speculative decoding reproduces greedy decoding without a repetition penalty, within the context
+    # window (past it, the cropped window shifts every position and the KV cache cannot be used)
+    return (not torch.is_tensor(temperature) and temperature <= 0.0 and use_cache
+            and repetition_penalty == 1.0 and idx.shape[1] + max_new_tokens <= context_size)
+
+
+def speculative_decode(model, draft_model, idx, max_new_tokens, num_speculative=4, eos_id=None,
+                       prefix_cache=None):
+    # Greedy speculative decoding. Every round, the small draft model proposes num_speculative
+    # tokens one at a time, and the model scores the last accepted token and all proposals in a
+    # single forward pass over its KV cache. Proposals are kept up to the first one that differs
+    # from the model's own greedy pick, followed by the model's pick at that position, so the
+    # result is exactly what greedy generate() returns (a batch keeps the shortest accepted prefix).
+    # draft_model must be a separate GPTModel instance (it keeps its own KV cache) with the same vocabulary.
+    # Yields (new_tokens of shape (batch_size, n), accepted proposals, proposed tokens) per round.
+    batch_size, num_tokens = idx.shape
+    out = idx.new_empty((batch_size, num_tokens + max_new_tokens))
+    out[:, :num_tokens] = idx
+    model.reset_kv_cache()
+    draft_model.reset_kv_cache()
+    try:
+        with torch.no_grad():
+            # The model's next token is always known and not cached yet
+            next_token = prefill(model, idx, prefix_cache=prefix_cache).argmax(dim=-1, keepdim=True)
+            generated = 0
+            while generated < max_new_tokens:
+                k = min(num_speculative, max_new_tokens - generated - 1)
+                out[:, num_tokens] = next_token[:, 0]
+                if generated + 1 == max_new_tokens:
+                    new_tokens, accepted = next_token, 0  # Last token: nothing left to verify
+                else:
+                    # Draft: catch up on the tokens it has not seen, then propose k tokens
+                    draft_input = out[:, draft_model.current_pos:num_tokens + 1]
+                    proposals = idx.new_empty((batch_size, k))
+                    for i in range(k):
+                        logits = draft_model(draft_input, use_cache=True, output_positions=LAST_POSITION)[:, -1, :]
+                        draft_input = logits.argmax(dim=-1, keepdim=True)
+                        proposals[:, i] = draft_input[:, 0]
+
+                    # Verify: picks[:, i] is the model's token after proposal i (after next_token for i=0)
+                    picks = model(torch.cat([next_token, proposals], dim=1), use_cache=True).argmax(dim=-1)
+                    matches = (proposals == picks[:, :k]).all(dim=0).long()
+                    accepted = int(matches.cumprod(dim=0).sum())
+                    new_tokens = torch.cat([next_token, proposals[:, :accepted]], dim=1)
+
+                    # Roll both caches back to the accepted tokens
+                    model.trim_kv_cache(num_tokens + 1 + accepted)
+                    draft_model.trim_kv_cache(num_tokens + 1 + accepted)
+                    out[:, num_tokens + 1:num_tokens + 1 + accepted] = proposals[:, :accepted]
+                    next_token = picks[:, accepted:accepted + 1]
+
+                # Stop at the first position where every row produced the end-of-sequence token
+                if eos_id is not None:
+                    finished = (new_tokens == eos_id).all(dim=0).nonzero()
+                    if len(finished):
+                        end = int(finished[0])
+                        if end:
+                            yield new_tokens[:, :end], min(accepted, end - 1), k
+                        return
+
+                yield new_tokens, accepted, k
+                num_tokens += new_tokens.shape[1]
+                generated += new_tokens.shape[1]
+    finally:
+        model.reset_kv_cache()
+        draft_model.reset_kv_cache()
+
+
+def generate_text_simple(model, idx, max_new_tokens, context_size, use_cache=True):
     # idx is (batch, n_tokens) array of indices in the current context
 
     ###Input batch:
  ###tensor([[6109, 3626, 6100,  345],
         ##[6109, 1110, 6622,  257]])
 
-    for _ in range(max_new_tokens):
+    for step in range(max_new_tokens):
 
         # Crop current context if it exceeds the supported context size
         # E.g., if LLM supports only 5 tokens, and the context size is 10
-        # then only the last 5 tokens are used as context
-        idx_cond = idx[:, -context_size:]
-
-        # Get the predictions
-        with torch.no_grad():
-            logits = model(idx_cond) ### batch, n_tokens, vocab_size
-
-        # Focus only on the last time step
+        # then only the last 5 tokens are used as context.
+        # With the KV cache only the newest token is run after the first step.
         # (batch, n_tokens, vocab_size) becomes (batch, vocab_size)
-        logits = logits[:, -1, :]
+        logits = next_token_logits(model, idx, context_size, use_cache, step)
 
         # Apply softmax to get probabilities
         probas = torch.softmax(logits, dim=-1)  # (batch, vocab_size)
@@ -530,8 +1256,9 @@ def generate_text_simple(model, idx, max_new_tokens, context_size):
         # Append sampled index to the running sequence
         idx = torch.cat((idx, idx_next), dim=1)  # (batch, n_tokens+1)
 
+    if use_cache:
+        model.reset_kv_cache()
     return idx
-import tiktoken
 
 def text_to_token_ids(text, tokenizer):
     encoded = tokenizer.encode(text, allowed_special={'<|endoftext|>'})
@@ -542,43 +1269,178 @@ def token_ids_to_text(token_ids, tokenizer):
     flat = token_ids.squeeze(0) # remove batch dimension
     return tokenizer.decode(flat.tolist())
 
-start_context = "Every effort moves you"
-
-
-
-token_ids = generate_text_simple(
-    model=model,
-    idx=text_to_token_ids(start_context, tokenizer),
-    max_new_tokens=10,
-    context_size=GPT_CONFIG_124M["context_length"]
-)
-
-print("Output text:\n", token_ids_to_text(token_ids, tokenizer))
+def token_ids_to_text_stream(token_ids, tokenizer):
+    # GPT-2 BPE tokens are byte sequences and one can end in the middle of a UTF-8
+    # character, so decode incrementally and only emit text for complete characters
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for token_id in token_ids:
+        text = decoder.decode(tokenizer.decode_single_token_bytes(int(token_id)))
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
 
 
-
-model = GPTModel(GPT_CONFIG_124M)
-torch.save(model.state_dict(), "model.pth")
-
-
-optimizer = torch.optim.AdamW(model.parameters(), lr=0.0004, weight_decay=0.1)
-
-##import tensorflow as tf
-##import tqdm
-##
-##print("TensorFlow version:", tf.__version__)
-##print("tqdm version:", tqdm.__version__)
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# from gpt_download3 import download_and_load_gpt2
-
-settings, params = download_and_load_gpt2(model_size="124M", models_dir="gpt2")
-
-print("Settings:", settings)
-print("Parameter dictionary keys:", params.keys())
-
-print(params["wte"])
-print("Token embedding weight tensor dimensions:", params["wte"].shape)
+##################################################################################################
+def calc_loss_batch(input_batch, target_batch, model, device):
+    input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+    logits = model(input_batch)
+    # Targets set to -100 (padding, masked prompt tokens) are ignored by cross_entropy
+    loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), target_batch.flatten())
+    return loss
+
+def calc_loss_loader(data_loader, model, device, num_batches=None):
+    total_loss = 0.
+    if len(data_loader) == 0:
+        return float("nan")
+    elif num_batches is None:
+        num_batches = len(data_loader)
+    else:
+        # Reduce the number of batches to match the total number of batches in the data loader
+        num_batches = min(num_batches, len(data_loader))
+    for i, (input_batch, target_batch) in enumerate(data_loader):
+        if i >= num_batches:
+            break
+        loss = calc_loss_batch(input_batch, target_batch, model, device)
+        total_loss += loss.item()
+    return total_loss / num_batches
+
+def evaluate_model(model, train_loader, val_loader, device, eval_iter, use_bf16=False):
+    # Bounded evaluation: at most `eval_iter` batches from each loader
+    model.eval()
+    with torch.no_grad(), torch.autocast(device_type=torch.device(device).type,
+                                         dtype=torch.bfloat16, enabled=use_bf16):
+        train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
+        val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
+    model.train()
+    return train_loss, val_loss
+
+def get_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def set_loader_epoch(data_loader, epoch):
+    # Samplers with their own per-epoch shuffling (DistributedSampler, LengthBucketSampler, ...)
+    for sampler in (data_loader.sampler, data_loader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+
+def save_training_checkpoint(path, model, optimizer, epoch, batch_idx, global_step,
+                             epoch_rng_state, train_losses, val_losses, fingerprint=None):
+    # Written to a temporary file and renamed, so a killed run never leaves a truncated checkpoint
+    tmp_path = path + ".tmp"
+    torch.save({
+        "model_state_dict": model.state_dict(),
+        "optimizer_state_dict": optimizer.state_dict(),
+        "epoch": epoch,
+        "batch_idx": batch_idx,  # Batches of `epoch` already trained on
+        "global_step": global_step,
+        "epoch_rng_state": epoch_rng_state,  # RNG state when `epoch` started (reproduces its shuffle)
+        "rng_state": get_rng_state(),
+        "train_losses": train_losses,
+        "val_losses": val_losses,
+        "fingerprint": fingerprint,  # Data and hyperparameters the run was started with
+        },
+        tmp_path
+    )
+    os.replace(tmp_path, path)
+
+def train_model(model, train_loader, val_loader, optimizer, device, num_epochs,
+                eval_freq=100, eval_iter=5, accumulation_steps=1, use_bf16=False,
+                gradient_checkpointing=False, checkpoint_path=None, checkpoint_freq=500, resume=True,
+                fingerprint=None):
+    # use_bf16: bfloat16 autocast (also on CPU); gradient_checkpointing: recompute each
+    # TransformerBlock in backward to fit larger batches; accumulation_steps: batches per
+    # optimizer step. With checkpoint_path set, an existing checkpoint is resumed from the
+    # exact batch (same shuffle order and RNG state) it was written at. fingerprint (a dict of
+    # the data hash and hyperparameters) is stored in the checkpoint; resuming a checkpoint
+    # written with a different one raises instead of mixing two runs.
+    train_losses, val_losses = [], []
+    start_epoch, start_batch, global_step = 0, 0, -1
+    epoch_rng_state = resume_rng_state = None
+
+    if checkpoint_path is not None and resume and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+        saved = checkpoint.get("fingerprint")
+        if saved != fingerprint:
+            changed = sorted(key for key in set(saved or {}) | set(fingerprint or {})
+                             if (saved or {}).get(key) != (fingerprint or {}).get(key))
+            raise ValueError(f"{checkpoint_path} was written by a run with different {', '.join(changed)}; "
+                             f"delete it or train without resuming")
+        model.load_state_dict(checkpoint["model_state_dict"])
+        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        start_epoch, start_batch = checkpoint["epoch"], checkpoint["batch_idx"]
+        global_step = checkpoint["global_step"]
+        train_losses, val_losses = checkpoint["train_losses"], checkpoint["val_losses"]
+        epoch_rng_state, resume_rng_state = checkpoint["epoch_rng_state"], checkpoint["rng_state"]
+        print(f"Resuming from {checkpoint_path}: epoch {start_epoch+1}, batch {start_batch}")
+
+    model.gradient_checkpointing = gradient_checkpointing
+    device_type = torch.device(device).type
+
+    for epoch in range(start_epoch, num_epochs):
+        if epoch == start_epoch and epoch_rng_state is not None:
+            set_rng_state(epoch_rng_state)
+        else:
+            epoch_rng_state = get_rng_state()
+        set_loader_epoch(train_loader, epoch)
+
+        model.train()
+        optimizer.zero_grad()
+        num_batches = len(train_loader)
+        batches = iter(train_loader)
+
+        # Skip the batches trained on before the checkpoint, then continue with its RNG state
+        skip = start_batch if epoch == start_epoch else 0
+        if skip:
+            next(islice(batches, skip - 1, None), None)
+            set_rng_state(resume_rng_state)
+
+        for batch_idx, (input_batch, target_batch) in enumerate(batches, start=skip):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_bf16):
+                loss = calc_loss_batch(input_batch, target_batch, model, device) / accumulation_steps
+            loss.backward()
+
+            if (batch_idx + 1) % accumulation_steps != 0 and batch_idx + 1 != num_batches:
+                continue
+            optimizer.step()
+            optimizer.zero_grad()
+            global_step += 1
+
+            if global_step % eval_freq == 0:
+                train_loss, val_loss = evaluate_model(
+                    model, train_loader, val_loader, device, eval_iter, use_bf16)
+                train_losses.append(train_loss)
+                val_losses.append(val_loss)
+                print(f"Ep {epoch+1} (Step {global_step:06d}): "
+                      f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+
+            if checkpoint_path is not None and global_step % checkpoint_freq == 0:
+                save_training_checkpoint(checkpoint_path, model, optimizer, epoch, batch_idx + 1,
+                                         global_step, epoch_rng_state, train_losses, val_losses,
+                                         fingerprint)
+
+        if checkpoint_path is not None:
+            save_training_checkpoint(checkpoint_path, model, optimizer, epoch + 1, 0,
+                                     global_step, get_rng_state(), train_losses, val_losses,
+                                     fingerprint)
+
+    model.gradient_checkpointing = False
+    return train_losses, val_losses
 
 
 # Define model configurations in a dictionary for compactness
@@ -589,14 +1451,6 @@ model_configs = {
     "gpt2-xl (1558M)": {"emb_dim": 1600, "n_layers": 48, "n_heads": 25},
 }
 
-# Copy the base configuration and update with specific model settings
-model_name = "gpt2-small (124M)"  # Example model name
-NEW_CONFIG = GPT_CONFIG_124M.copy()
-NEW_CONFIG.update(model_configs[model_name])
-
-NEW_CONFIG.update({"context_length": 1024, "qkv_bias": True})
-gpt = GPTModel(NEW_CONFIG)
-gpt.eval();
 
 def assign(left, right):
     if left.shape != right.shape:
@@ -604,31 +1458,39 @@ def assign(left, right):
     return torch.nn.Parameter(torch.tensor(right, dtype=torch.float32, device=left.device))
 
 
-
-import numpy as np
-
 def load_weights_into_gpt(gpt, params):
+    # assign() creates new parameters, so a tied model (tie_weights=True) is re-tied at the end
+    tied = gpt.out_head.weight is gpt.tok_emb.weight
     gpt.pos_emb.weight = assign(gpt.pos_emb.weight, params['wpe'])
     gpt.tok_emb.weight = assign(gpt.tok_emb.weight, params['wte'])
 
     for b in range(len(params["blocks"])):
-        q_w, k_w, v_w = np.split(
-            (params["blocks"][b]["attn"]["c_attn"])["w"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.weight = assign(
-            gpt.trf_blocks[b].att.W_query.weight, q_w.T)
-        gpt.trf_blocks[b].att.W_key.weight = assign(
-            gpt.trf_blocks[b].att.W_key.weight, k_w.T)
-        gpt.trf_blocks[b].att.W_value.weight = assign(
-            gpt.trf_blocks[b].att.W_value.weight, v_w.T)
-
-        q_b, k_b, v_b = np.split(
-            (params["blocks"][b]["attn"]["c_attn"])["b"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.bias = assign(
-            gpt.trf_blocks[b].att.W_query.bias, q_b)
-        gpt.trf_blocks[b].att.W_key.bias = assign(
-            gpt.trf_blocks[b].att.W_key.bias, k_b)
-        gpt.trf_blocks[b].att.W_value.bias = assign(
-            gpt.trf_blocks[b].att.W_value.bias, v_b)
+        if gpt.trf_blocks[b].att.fused:
+            # The GPT-2 c_attn matrix is already packed as [query | key | value]
+            gpt.trf_blocks[b].att.W_qkv.weight = assign(
+                gpt.trf_blocks[b].att.W_qkv.weight,
+                params["blocks"][b]["attn"]["c_attn"]["w"].T)
+            gpt.trf_blocks[b].att.W_qkv.bias = assign(
+                gpt.trf_blocks[b].att.W_qkv.bias,
+                params["blocks"][b]["attn"]["c_attn"]["b"])
+        else:
+            q_w, k_w, v_w = np.split(
+                (params["blocks"][b]["attn"]["c_attn"])["w"], 3, axis=-1)
+            gpt.trf_blocks[b].att.W_query.weight = assign(
+                gpt.trf_blocks[b].att.W_query.weight, q_w.T)
+            gpt.trf_blocks[b].att.W_key.weight = assign(
+                gpt.trf_blocks[b].att.W_key.weight, k_w.T)
+            gpt.trf_blocks[b].att.W_value.weight = assign(
+                gpt.trf_blocks[b].att.W_value.weight, v_w.T)
+
+            q_b, k_b, v_b = np.split(
+                (params["blocks"][b]["attn"]["c_attn"])["b"], 3, axis=-1)
+            gpt.trf_blocks[b].att.W_query.bias = assign(
+                gpt.trf_blocks[b].att.W_query.bias, q_b)
+            gpt.trf_blocks[b].att.W_key.bias = assign(
+                gpt.trf_blocks[b].att.W_key.bias, k_b)
+            gpt.trf_blocks[b].att.W_value.bias = assign(
+                gpt.trf_blocks[b].att.W_value.bias, v_b)
 
         gpt.trf_blocks[b].att.out_proj.weight = assign(
             gpt.trf_blocks[b].att.out_proj.weight,
@@ -665,48 +1527,309 @@ def load_weights_into_gpt(gpt, params):
 
     gpt.final_norm.scale = assign(gpt.final_norm.scale, params["g"])
     gpt.final_norm.shift = assign(gpt.final_norm.shift, params["b"])
-    gpt.out_head.weight = assign(gpt.out_head.weight, params["wte"])
+    if tied:
+        gpt.out_head.weight = gpt.tok_emb.weight  # One wte matrix for both
+    else:
+        gpt.out_head.weight = assign(gpt.out_head.weight, params["wte"])
+
+
+def save_merged_checkpoint(gpt, cfg, path):
+    # A single, fully populated checkpoint: no TensorFlow and no GPT-2 download needed to load it.
+    # Written to a temporary file first so an interrupted conversion never leaves a broken file.
+    tmp_path = path + ".tmp"
+    torch.save({"config": dict(cfg), "model_state_dict": gpt.state_dict()}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_merged_checkpoint(path, device="cpu"):
+    # mmap=True maps the tensors straight from the file, and building the model on the
+    # meta device + assign=True makes the parameters use those tensors without extra copies
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    with torch.device("meta"):
+        gpt = GPTModel(checkpoint["config"])
+    gpt.load_state_dict(checkpoint["model_state_dict"], assign=True)
+    if checkpoint["config"].get("tie_weights", False):
+        tie_output_head(gpt)  # assign=True gave both keys their own parameter
+    gpt.eval()
+    return gpt.to(device)
+
+
+QUANTIZATION_MODES = ("fp32", "int8", "bf16")
+
+
+def quantize_gpt(gpt, mode="int8"):
+    # CPU inference modes:
+    #   int8: dynamic quantization of every nn.Linear (attention projections, FeedForward, out_head);
+    #         weights are stored as int8, activations are quantized on the fly
+    #   bf16: the whole model in bfloat16 (half the memory, native bf16 matmuls where supported)
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Quantization mode not in {QUANTIZATION_MODES}")
+    gpt.eval()
+    if mode == "int8":
+        return torch.ao.quantization.quantize_dynamic(gpt, {nn.Linear}, dtype=torch.qint8)
+    if mode == "bf16":
+        return gpt.to(torch.bfloat16)
+    return gpt
+
+
+def save_quantized_checkpoint(gpt, cfg, mode, path):
+    tmp_path = path + ".tmp"
+    torch.save({"config": dict(cfg), "quantization": mode, "model_state_dict": gpt.state_dict()}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_quantized_checkpoint(path):
+    # Quantized modules can only be created from a float model, so build an uninitialized
+    # model (no random init), quantize it and then load the stored quantized weights
+    checkpoint = torch.load(path, map_location="cpu")
+    with torch.device("meta"):
+        gpt = GPTModel(checkpoint["config"])
+    gpt = quantize_gpt(gpt.to_empty(device="cpu"), checkpoint["quantization"])
+    gpt.load_state_dict(checkpoint["model_state_dict"])
+    gpt.eval()
+    return gpt
+
+
+COMPILE_MODES = ("none", "torch.compile", "torchscript")
+
+
+def set_fused_kernels(gpt, enabled=True):
+    # Fast inference mode for an existing model: native LayerNorm and tanh-GELU kernels
+    # (same parameters, same state_dict, results equal up to float rounding)
+    for module in gpt.modules():
+        if isinstance(module, (LayerNorm, GELU)):
+            module.fused = enabled
+    return gpt
+
+
+def compile_gpt(gpt, mode="torch.compile", cache_dir="gpt_compile_cache"):
+    # Compiles the stateless parts of the model: the norms and FeedForward of every TransformerBlock
+    # and the final norm. Attention keeps its Python-side KV cache and stays eager.
+    # The compiled artifacts are cached in cache_dir (the inductor cache for torch.compile, saved
+    # TorchScript modules for torchscript). Any failure leaves the model eager, with a warning.
+    if mode not in COMPILE_MODES:
+        raise ValueError(f"Compile mode not in {COMPILE_MODES}")
+    if mode == "none":
+        return gpt
+    os.makedirs(cache_dir, exist_ok=True)
+
+    targets = [(block, name) for block in gpt.trf_blocks for name in ("norm1", "ff", "norm2")]
+    targets.append((gpt, "final_norm"))
+    originals = [getattr(parent, name) for parent, name in targets]
+    try:
+        for parent, name in targets:
+            module = getattr(parent, name)
+            if mode == "torch.compile":
+                setattr(parent, name, _torch_compile_module(module, cache_dir))
+            else:
+                setattr(parent, name, _torchscript_module(module, cache_dir))
+        # torch.compile only compiles on the first call: run one now so failures surface here
+        sample = torch.zeros(1, 2, gpt.tok_emb.embedding_dim,
+                             dtype=gpt.tok_emb.weight.dtype, device=gpt.tok_emb.weight.device)
+        with torch.no_grad():
+            for parent, name in targets:
+                getattr(parent, name)(sample)
+    except Exception as e:
+        for (parent, name), module in zip(targets, originals):
+            # module.compile() works in place, so the original modules have to be un-compiled too
+            module._compiled_call_impl = None
+            setattr(parent, name, module)
+        print(f"⚠️ {mode} is not available ({e!r}), running the model eagerly")
+    return gpt
+
+
+def _torch_compile_module(module, cache_dir):
+    # Inductor's FX graph cache keeps the generated kernels across processes
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    # dynamic=True: one graph for every sequence length (prefill and single-token decode steps)
+    module.compile(dynamic=True)  # In place, so the state_dict keys stay the same
+    return module
+
+
+def _torchscript_module(module, cache_dir):
+    # The scripted module only depends on the architecture, so it is cached per architecture
+    # and gets this model's weights through load_state_dict
+    signature = f"{torch.__version__}|{module!r}|{[m.fused for m in module.modules() if hasattr(m, 'fused')]}"
+    digest = hashlib.sha256(signature.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{type(module).__name__}_{digest}.pt")
+    if os.path.exists(path):
+        scripted = torch.jit.load(path, map_location=next(module.parameters()).device)
+    else:
+        scripted = torch.jit.script(module)
+        tmp_path = path + ".tmp"
+        torch.jit.save(scripted, tmp_path)
+        os.replace(tmp_path, path)
+    scripted.load_state_dict(module.state_dict())
+    return scripted.eval()
+
+
+##################################################################################################
+# Demo / training script. Nothing below runs on `import gpt_arc`; use `python gpt_arc.py`.
+##################################################################################################
+
+def main():
+    text_data = load_verdict_text()
+
+    ##############################
+    # First 100 characters
+    print(text_data[:99])
+
+    # Last 100 characters
+    print(text_data[-99:])
+
+    ############################
+    tokenizer = get_tokenizer()
+
+    total_characters = len(text_data)
+    total_tokens = len(tokenizer.encode(text_data))
+
+    print("Characters:", total_characters)
+    print("Tokens:", total_tokens)
+
+    ##############################
+
+    # Train/validation ratio
+    train_ratio = 0.90
+    split_idx = int(train_ratio * len(text_data))
+    train_data = text_data[:split_idx]
+    val_data = text_data[split_idx:]
 
+    torch.manual_seed(123)
 
-load_weights_into_gpt(gpt, params)
-gpt.to(device);
+    train_loader = create_dataloader_v1(
+        train_data,
+        batch_size=2,
+        max_length=GPT_CONFIG_124M["context_length"],
+        stride=GPT_CONFIG_124M["context_length"],
+        drop_last=True,
+        shuffle=True,
+        num_workers=0
+    )
+
+    val_loader = create_dataloader_v1(
+        val_data,
+        batch_size=2,
+        max_length=GPT_CONFIG_124M["context_length"],
+        stride=GPT_CONFIG_124M["context_length"],
+        drop_last=False,
+        shuffle=False,
+        num_workers=0
+    )
+
+    ###############################
+
+    # Sanity check
+
+    if total_tokens * (train_ratio) < GPT_CONFIG_124M["context_length"]:
+        print("Not enough tokens for the training loader. "
+              "Try to lower the `GPT_CONFIG_124M['context_length']` or "
+              "increase the `training_ratio`")
 
-torch.manual_seed(123)
+    if total_tokens * (1-train_ratio) < GPT_CONFIG_124M["context_length"]:
+        print("Not enough tokens for the validation loader. "
+              "Try to lower the `GPT_CONFIG_124M['context_length']` or "
+              "decrease the `training_ratio`")
 
-token_ids = generate(
-    model=gpt,
-    idx=text_to_token_ids("hello peoples", tokenizer).to(device),
-    max_new_tokens=25,
-    context_size=NEW_CONFIG["context_length"],
-    top_k=50,
-    temperature=1.5
-)
+    ###################################
 
-print("Output text:\n", token_ids_to_text(token_ids, tokenizer))
+    print("Train loader:")
+    for x, y in train_loader:
+        print(x.shape, y.shape)
 
+    print("\nValidation loader:")
+    for x, y in val_loader:
+        print(x.shape, y.shape)
 
+    print(len(train_loader))
+    print(len(val_loader))
 
+    ##################################
 
+    train_tokens = 0
+    for input_batch, target_batch in train_loader:
+        train_tokens += input_batch.numel()
 
-torch.save({
-    "model_state_dict": model.state_dict(),
-    "optimizer_state_dict": optimizer.state_dict(),
-    },
-    "model_and_optimizer.pth"
-)
+    val_tokens = 0
+    for input_batch, target_batch in val_loader:
+        val_tokens += input_batch.numel()
 
+    print("Training tokens:", train_tokens)
+    print("Validation tokens:", val_tokens)
+    print("All tokens:", train_tokens + val_tokens)
+
+    #####################################
+
+    torch.manual_seed(123)
+    model = GPTModel(GPT_CONFIG_124M)
+    model.eval()  # Disable dropout during inference
+
+    start_context = "Every effort moves you"
+
+    token_ids = generate_text_simple(
+        model=model,
+        idx=text_to_token_ids(start_context, tokenizer),
+        max_new_tokens=10,
+        context_size=GPT_CONFIG_124M["context_length"]
+    )
 
+    print("Output text:\n", token_ids_to_text(token_ids, tokenizer))
 
+    model = GPTModel(GPT_CONFIG_124M)
+    torch.save(model.state_dict(), "model.pth")
 
-checkpoint = torch.load("model_and_optimizer.pth")
-model = GPTModel(GPT_CONFIG_124M)
-model.load_state_dict(checkpoint["model_state_dict"])
-optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4, weight_decay=0.1)
-optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
-model.train();
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.0004, weight_decay=0.1)
 
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+    settings, params = download_and_load_gpt2(model_size="124M", models_dir="gpt2")
 
+    print("Settings:", settings)
+    print("Parameter dictionary keys:", params.keys())
+
+    print(params["wte"])
+    print("Token embedding weight tensor dimensions:", params["wte"].shape)
+
+    # Copy the base configuration and update with specific model settings
+    model_name = "gpt2-small (124M)"  # Example model name
+    NEW_CONFIG = GPT_CONFIG_124M.copy()
+    NEW_CONFIG.update(model_configs[model_name])
+
+    NEW_CONFIG.update({"context_length": 1024, "qkv_bias": True})
+    gpt = GPTModel(NEW_CONFIG)
+    gpt.eval()
+
+    load_weights_into_gpt(gpt, params)
+    gpt.to(device)
+
+    torch.manual_seed(123)
+
+    token_ids = generate(
+        model=gpt,
+        idx=text_to_token_ids("hello peoples", tokenizer).to(device),
+        max_new_tokens=25,
+        context_size=NEW_CONFIG["context_length"],
+        top_k=50,
+        temperature=1.5
+    )
+
+    print("Output text:\n", token_ids_to_text(token_ids, tokenizer))
+
+    torch.save({
+        "model_state_dict": model.state_dict(),
+        "optimizer_state_dict": optimizer.state_dict(),
+        },
+        "model_and_optimizer.pth"
+    )
 
+    checkpoint = torch.load("model_and_optimizer.pth")
+    model = GPTModel(GPT_CONFIG_124M)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4, weight_decay=0.1)
+    optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+    model.train()
 
 
+if __name__ == "__main__":
+    main()
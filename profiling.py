@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from gpt_arc import GPTModel, TransformerBlock, MultiHeadAttention, FeedForward
+
+# Opt-in instrumentation for GPTModel and the assistant pipeline.
+#
+# Profiler.attach(model) registers forward hooks on GPTModel, TransformerBlock, MultiHeadAttention
+# and FeedForward that record wall time, a FLOP estimate and the output activation size per module
+# per forward. span(name) times a pipeline stage. Nothing is hooked until a profiler is enabled,
+# and span() only checks a global while profiling is off.
+# Export with Profiler.chrome_trace() (chrome://tracing, Perfetto) or Profiler.prometheus().
+
+PROFILED_MODULES = (GPTModel, TransformerBlock, MultiHeadAttention, FeedForward)
+
+profiler = None  # The active Profiler, None while profiling is off
+_NO_SPAN = nullcontext()
+
+
+class Profiler:
+    def __init__(self, max_events=100_000, sync_cuda=False):
+        self.events = deque(maxlen=max_events)  # Chrome trace events, oldest dropped first
+        self.sync_cuda = sync_cuda  # Wait for CUDA kernels so module times are not just launch times
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.module_stats = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "flops": 0, "activation_bytes": 0})
+        self.span_stats = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        self.handles = []
+        self.local = threading.local()  # Per-thread stack of open module timings
+
+    #####################################
+    # Module hooks
+
+    def attach(self, model):
+        names = {module: name for name, module in model.named_modules()}
+        for module, name in names.items():
+            if isinstance(module, PROFILED_MODULES):
+                info = module_info(module, name or type(module).__name__)
+                self.handles.append(module.register_forward_pre_hook(
+                    lambda module, args, info=info: self._pre_forward(module, args, info)))
+                self.handles.append(module.register_forward_hook(
+                    lambda module, args, output, info=info: self._post_forward(module, args, output, info)))
+        return model
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def _pre_forward(self, module, args, info):
+        if self.sync_cuda and args[0].is_cuda:
+            torch.cuda.synchronize()
+        attention = info["attention"]
+        cache_pos = attention[0].ptr_current_pos if attention else 0
+        self._stack().append((time.perf_counter(), cache_pos))
+
+    def _post_forward(self, module, args, output, info):
+        if self.sync_cuda and output.is_cuda:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        start, cache_pos = self._stack().pop()
+
+        batch_size, num_tokens = args[0].shape[:2]
+        # GPTModel's output head only runs on the positions it returns (see output_positions)
+        flops = 2 * batch_size * (num_tokens * (info["linear_macs"] - info["head_macs"])
+                                  + output.shape[1] * info["head_macs"])
+        attention = info["attention"]
+        if attention:
+            # Attention scores and weighted values: 2 matmuls over all keys, incl. cached ones
+            cache_end = attention[0].ptr_current_pos
+            num_keys = cache_end if cache_end != cache_pos else num_tokens
+            flops += sum(4 * batch_size * num_tokens * num_keys * att.d_out for att in attention)
+        activation_bytes = output.numel() * output.element_size()
+
+        self._record(info["name"], "module", start, end, {
+            "type": info["type"],
+            "shape": list(args[0].shape),
+            "flops": flops,
+            "activation_bytes": activation_bytes,
+        })
+        with self.lock:
+            stats = self.module_stats[(info["name"], info["type"])]
+            stats["calls"] += 1
+            stats["seconds"] += end - start
+            stats["flops"] += flops
+            stats["activation_bytes"] += activation_bytes
+
+    #####################################
+    # Pipeline spans
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._record(name, "span", start, end, args)
+            with self.lock:
+                stats = self.span_stats[name]
+                stats["calls"] += 1
+                stats["seconds"] += end - start
+
+    def _record(self, name, category, start, end, args):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",  # Complete event; nesting follows from the timestamps
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+    #####################################
+    # Export
+
+    def chrome_trace(self, path=None):
+        trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(trace, file)
+        return trace
+
+    def prometheus(self):
+        with self.lock:
+            module_stats = dict(self.module_stats)
+            span_stats = dict(self.span_stats)
+
+        lines = []
+        for metric, key, help_text in [
+            ("gpt_module_calls_total", "calls", "Forward calls per module"),
+            ("gpt_module_seconds_total", "seconds", "Wall time spent in forward per module"),
+            ("gpt_module_flops_total", "flops", "Estimated floating point operations per module"),
+            ("gpt_module_activation_bytes_total", "activation_bytes", "Bytes of module outputs produced"),
+        ]:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for (name, module_type), stats in module_stats.items():
+                lines.append(f'{metric}{{module="{name}",type="{module_type}"}} {stats[key]}')
+        for metric, key, help_text in [
+            ("pipeline_span_calls_total", "calls", "Pipeline stage executions"),
+            ("pipeline_span_seconds_total", "seconds", "Wall time spent per pipeline stage"),
+        ]:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for name, stats in span_stats.items():
+                lines.append(f'{metric}{{span="{name}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+def module_info(module, name):
+    # Static part of the FLOP estimate: multiply-accumulates per token of every linear layer
+    # (nn.Linear and its quantized variants), and the attention modules inside this module
+    linear_macs = sum(m.in_features * m.out_features for m in module.modules() if hasattr(m, "in_features"))
+    head_macs = module.out_head.in_features * module.out_head.out_features if isinstance(module, GPTModel) else 0
+    attention = [m for m in module.modules() if isinstance(m, MultiHeadAttention)]
+    return {"name": name, "type": type(module).__name__, "linear_macs": linear_macs, "head_macs": head_macs,
+            "attention": attention}
+
+
+def enable(model=None, max_events=100_000, sync_cuda=False):
+    global profiler
+    if profiler is None:
+        profiler = Profiler(max_events=max_events, sync_cuda=sync_cuda)
+    if model is not None:
+        profiler.attach(model)
+    return profiler
+
+
+def disable():
+    # Removes the hooks and returns the profiler with everything recorded so far
+    global profiler
+    finished, profiler = profiler, None
+    if finished is not None:
+        finished.detach()
+    return finished
+
+
+def attach(model):
+    # Instruments the model only while profiling is on
+    if profiler is not None:
+        profiler.attach(model)
+    return model
+
+
+def span(name, **args):
+    if profiler is None:
+        return _NO_SPAN
+    return profiler.span(name, **args)
@@ -0,0 +1,117 @@
+import os
+import json
+import pickle
+from functools import lru_cache
+
+# Versioned UPDRS question bank.
+#
+# The questions live in a JSON data file (updrs_questions_v1.json); set UPDRS_QUESTION_BANK to
+# use another version without code changes. The first load checks the schema and writes a
+# compiled pickle next to the file, which later loads use for as long as the JSON is unchanged.
+
+QUESTION_BANK_PATH = os.environ.get(
+    "UPDRS_QUESTION_BANK", os.path.join(os.path.dirname(os.path.abspath(__file__)), "updrs_questions_v1.json"))
+CACHE_FORMAT = 1
+REQUIRED_FIELDS = ("section", "question_id", "title", "prompt", "choices")
+
+
+class QuestionBank:
+    def __init__(self, name, version, questions):
+        self.name = name
+        self.version = version
+        self.questions = questions  # In questionnaire order, same dicts as the JSON file
+
+        # O(1) lookups
+        self.by_id = {q["question_id"]: q for q in questions}
+        self.position = {q["question_id"]: i for i, q in enumerate(questions)}
+        self.by_section = {}
+        for q in questions:
+            self.by_section.setdefault(q["section"], []).append(q)
+        self.sections = list(self.by_section)
+        self.valid_choices = {q["question_id"]: frozenset(int(k) for k in q["choices"]) for q in questions}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __iter__(self):
+        return iter(self.questions)
+
+    def get(self, question_id):
+        return self.by_id[str(question_id)]
+
+    def section(self, name):
+        return self.by_section[name]
+
+    def is_valid(self, question_id, value):
+        choices = self.valid_choices.get(str(question_id))
+        return choices is not None and isinstance(value, int) and value in choices
+
+    def validate_responses(self, responses, require_all=True):
+        # Problems with a {question_id: answer} dict, as a list of messages (empty when valid)
+        errors = []
+        for question_id, value in responses.items():
+            if str(question_id) not in self.by_id:
+                errors.append(f"Unknown question {question_id}")
+            elif not self.is_valid(question_id, value):
+                errors.append(f"Invalid answer {value!r} for question {question_id}")
+        if require_all:
+            answered = {str(question_id) for question_id in responses}
+            missing = [qid for qid in self.by_id if qid not in answered]
+            if missing:
+                errors.append(f"Missing answers for question(s) {', '.join(missing)}")
+        return errors
+
+
+def check_question_bank(data):
+    # Schema check; raises ValueError listing every problem
+    errors = []
+    for field in ("version", "questions"):
+        if field not in data:
+            errors.append(f"Missing top-level field {field!r}")
+    seen = set()
+    for i, q in enumerate(data.get("questions", [])):
+        missing = [field for field in REQUIRED_FIELDS if field not in q]
+        if missing:
+            errors.append(f"Question #{i + 1} is missing {', '.join(missing)}")
+            continue
+        if q["question_id"] in seen:
+            errors.append(f"Duplicate question_id {q['question_id']}")
+        seen.add(q["question_id"])
+        if not q["choices"]:
+            errors.append(f"Question {q['question_id']} has no choices")
+        elif not all(str(k).lstrip("-").isdigit() for k in q["choices"]):
+            errors.append(f"Question {q['question_id']} has non-integer choice keys")
+    if errors:
+        raise ValueError("Invalid question bank:\n  " + "\n  ".join(errors))
+
+
+def compile_question_bank(path):
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    check_question_bank(data)
+    return QuestionBank(data.get("name", ""), str(data["version"]), data["questions"])
+
+
+@lru_cache(maxsize=None)
+def load_question_bank(path=QUESTION_BANK_PATH):
+    stat = os.stat(path)
+    source = (CACHE_FORMAT, stat.st_size, stat.st_mtime_ns)
+    cache_path = path + ".cache"
+    try:
+        with open(cache_path, "rb") as file:
+            cached_source, bank = pickle.load(file)
+        if cached_source == source:
+            return bank
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        pass
+
+    bank = compile_question_bank(path)
+    # Best effort: a read-only checkout just compiles on every start
+    try:
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump((source, bank), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return bank
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from updrs_prompts import format_instruction
+from response_table import reachable_scores, table_covers
+
+# Event-driven UPDRS questionnaire, independent of input() and of how answers arrive
+# (CLI, Streamlit callbacks, batch replay).
+#
+# QuestionnaireEngine keeps the running score and emits events to its listeners:
+#   {"type": "question", "index", "question"}           the next question to ask
+#   {"type": "answer", "question_id", "value", "score", "bounds", "answered"}
+#   {"type": "invalid", "question_id", "value"}         an answer outside the question's choices
+#   {"type": "complete", "score", "responses", "partial", "answered"}
+#
+# AssessmentSession hooks an engine up to updrs_pipeline: the models load in the background
+# while the patient answers, and once only a few final scores are still reachable their
+# recommendations are generated speculatively, so the result is ready when the last answer is.
+
+
+class QuestionnaireEngine:
+    def __init__(self, questions, listeners=None):
+        self.questions = questions
+        self.listeners = list(listeners or [])
+        self.responses = {}
+        self.position = 0
+        self.score = 0  # Running compute_updrs_score of the answers so far
+        self.finished = False
+        self.partial = False
+
+        # Lowest and highest total the unanswered questions can still add, per position
+        self.remaining_min = [0] * (len(questions) + 1)
+        self.remaining_max = [0] * (len(questions) + 1)
+        for i in range(len(questions) - 1, -1, -1):
+            choices = [int(k) for k in questions[i]["choices"]]
+            self.remaining_min[i] = self.remaining_min[i + 1] + min(choices)
+            self.remaining_max[i] = self.remaining_max[i + 1] + max(choices)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, event_type, **payload):
+        event = dict(payload, type=event_type)
+        for listener in self.listeners:
+            listener(event)
+
+    @property
+    def current_question(self):
+        return None if self.finished else self.questions[self.position]
+
+    @property
+    def answered(self):
+        return len(self.responses)
+
+    def score_bounds(self):
+        # Every total the questionnaire can still end with lies in [low, high]
+        if self.finished:
+            return self.score, self.score
+        return self.score + self.remaining_min[self.position], self.score + self.remaining_max[self.position]
+
+    def start(self):
+        if self.questions:
+            self.emit("question", index=self.position, question=self.current_question)
+        else:
+            self.finish()
+
+    def answer(self, value):
+        # Returns False (and emits "invalid") when the answer is not one of the question's choices
+        question = self.current_question
+        if question is None:
+            raise RuntimeError("The questionnaire is already complete")
+        value = str(value).strip()
+        if value not in question["choices"]:
+            self.emit("invalid", question_id=question["question_id"], value=value)
+            return False
+
+        self.responses[question["question_id"]] = int(value)
+        self.score += int(value)
+        self.position += 1
+        self.emit("answer", question_id=question["question_id"], value=int(value), score=self.score,
+                  bounds=self.score_bounds(), answered=self.answered)
+
+        if self.position == len(self.questions):
+            self.finish()
+        else:
+            self.emit("question", index=self.position, question=self.current_question)
+        return True
+
+    def finish(self):
+        # Early exit: the unanswered questions are left out of the (then partial) score
+        if self.finished:
+            return
+        self.partial = self.position < len(self.questions)
+        self.finished = True
+        self.emit("complete", score=self.score, responses=dict(self.responses), partial=self.partial,
+                  answered=self.answered)
+
+    def replay(self, answers):
+        # Batch replay of recorded answers, in question order; stops at the first invalid one
+        self.start()
+        for value in answers:
+            if self.finished or not self.answer(value):
+                break
+        return self.responses
+
+
+class AssessmentSession:
+    def __init__(self, engine, pipeline, response_table=None, speculate=True, max_candidates=5):
+        self.engine = engine
+        self.pipeline = pipeline
+        self.response_table = response_table
+        self.max_candidates = max_candidates
+        self.speculation = None  # Future of {score: recommendation}
+        # A table with every reachable total makes the GPT unnecessary (a miss still loads it lazily)
+        self.needs_llm = not table_covers(response_table, reachable_scores(engine.questions))
+
+        # One worker thread: the speculative generation queues up behind the model load,
+        # and the GPT is never used by two of our threads at once
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.models_loaded = self.executor.submit(self._load_models)
+        if speculate:
+            engine.subscribe(self._on_event)
+
+    def _load_models(self):
+        self.pipeline.load_ml_models()
+        if self.needs_llm:
+            self.pipeline.load_llm()
+
+    def _on_event(self, event):
+        if event["type"] != "answer" or self.speculation is not None:
+            return
+        low, high = event["bounds"]
+        candidates = [score for score in range(low, high + 1)
+                      if self.response_table is None or score not in self.response_table]
+        # Only the final score is missing from the prompt, so once few totals remain reachable
+        # all of their recommendations are generated as one batch
+        if high - low + 1 <= self.max_candidates and candidates:
+            self.speculation = self.executor.submit(self._generate, candidates)
+
+    def _generate(self, scores):
+        recommendations = self.pipeline.get_llm_responses([format_instruction(score) for score in scores])
+        return dict(zip(scores, recommendations))
+
+    def stream(self):
+        # Same events as updrs_pipeline.stream_assessment, plus how complete the answers were
+        self.models_loaded.result()  # Re-raises a failed model load
+        score = self.engine.score
+        yield {
+            "updrs_score": score,
+            "prediction": self.pipeline.predict_pd_status(score),
+            "partial": self.engine.partial,
+            "answered": self.engine.answered,
+        }
+
+        if self.speculation is not None:
+            speculated = self.speculation.result()
+            if score in speculated:
+                yield {"text": speculated[score]}
+                return
+        for chunk in self.pipeline.stream_recommendation(score, self.response_table):
+            yield {"text": chunk}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,58 @@
+import os
+import json
+import hashlib
+
+from gpt_arc import cached_file_sha256
+
+# The LLM prompt only depends on the integer UPDRS total and decoding is greedy,
+# so every possible recommendation can be generated once and looked up afterwards.
+
+TABLE_VERSION = 1
+
+
+def table_key(checkpoint_path, prompt_template, generation_settings=None):
+    # Any change to the weights, the prompt text or the decoding settings invalidates the table
+    sha = hashlib.sha256()
+    sha.update(f"v{TABLE_VERSION}".encode("utf-8"))
+    sha.update(cached_file_sha256(checkpoint_path).encode("utf-8"))
+    sha.update(prompt_template.encode("utf-8"))
+    sha.update(json.dumps(generation_settings or {}, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def reachable_scores(questions):
+    # Every item contributes between its lowest and highest choice to the total
+    low = sum(min(int(k) for k in q["choices"]) for q in questions)
+    high = sum(max(int(k) for k in q["choices"]) for q in questions)
+    return range(low, high + 1)
+
+
+def table_covers(table, scores):
+    # True when every score has a recommendation, so the GPT is never needed for them
+    return table is not None and all(score in table for score in scores)
+
+
+def build_response_table(respond, scores, key, table_path):
+    responses = {}
+    for score in scores:
+        responses[str(score)] = respond(score)
+        print(f"UPDRS score {score}: {responses[str(score)]}")
+
+    # Write to a temporary file first so a killed build never leaves a half-written table
+    tmp_path = table_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"version": TABLE_VERSION, "key": key, "responses": responses},
+                  file, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, table_path)
+    return responses
+
+
+def load_response_table(table_path, key):
+    # Returns None when the table is missing or was built for another checkpoint/template
+    if not os.path.exists(table_path):
+        return None
+    with open(table_path, "r", encoding="utf-8") as file:
+        table = json.load(file)
+    if table.get("version") != TABLE_VERSION or table.get("key") != key:
+        return None
+    return {int(score): text for score, text in table["responses"].items()}
@@ -0,0 +1,489 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+import numpy as np
+import torch
+import joblib
+import profiling
+from gpt_arc import GPTModel, download_and_load_gpt2, load_weights_into_gpt, generate, generate_batch
+from gpt_arc import generate_stream, token_ids_to_text_stream
+from gpt_arc import save_merged_checkpoint, load_merged_checkpoint
+from gpt_arc import QUANTIZATION_MODES, quantize_gpt, save_quantized_checkpoint, load_quantized_checkpoint
+from gpt_arc import COMPILE_MODES, set_fused_kernels, compile_gpt
+from gpt_arc import PrefixKVCache, get_tokenizer, tie_output_head
+from batch_scheduler import ContinuousBatchScheduler
+from response_table import table_key, build_response_table, load_response_table
+from updrs_prompts import RESPONSE_HEADER, format_instruction, format_input
+
+# Scoring, ML prediction and LLM recommendation for the Parkinson's assistant.
+# Used in-process by `final code.py` (local mode) and by the long-lived updrs_server.py.
+# Nothing is loaded on import: the models are loaded on first use.
+
+BASE_CONFIG = {
+    "vocab_size": 50257,
+    "context_length": 1024,
+    "emb_dim": 768,
+    "n_layers": 12,
+    "n_heads": 12,
+    "drop_rate": 0.0,
+    "qkv_bias": True,
+    "fused_attn": True  # Packed QKV + scaled_dot_product_attention
+}
+
+ml_model_path = "logistic_model.pkl"
+label_encoder_path = "label_encoder.pkl"
+fine_tuned_path = "Fine_tuned_updrs_model.pth"
+merged_checkpoint_path = "updrs_gpt_merged.pth"  # Written by --convert-checkpoint
+quantized_checkpoint_path = "updrs_gpt_{precision}.pth"  # Written by --write-quantized-checkpoint
+draft_model_path = "updrs_gpt_draft.pth"  # Written by distill_updrs_draft.py
+dataset_path = "LLM_UPDRS_5000_dataset_FIXED_HYPHEN.json"
+response_table_path = "updrs_response_table.json"
+MAX_NEW_TOKENS = 50
+EOS_ID = 50256
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# The tokenizer is gpt_arc's shared TokenizerService, fetched with get_tokenizer() where it is
+# used: creating it can download the BPE files, which must not happen on import
+
+ml_model = None
+label_encoder = None
+llm_model = None
+draft_model = None
+prefix_cache = None  # PrefixKVCache of llm_model
+LLM_PRECISION = "fp32"  # One of QUANTIZATION_MODES
+GPT2_OFFLINE = False  # Only use the local gpt2/ cache
+FAST_KERNELS = False  # Native fused LayerNorm/GELU kernels
+COMPILE_MODE = "none"  # One of COMPILE_MODES
+compile_cache_dir = "gpt_compile_cache"
+SPECULATIVE = False  # Speculative decoding with the distilled draft model
+NUM_SPECULATIVE = 4  # Draft tokens proposed per verification pass
+PREFIX_CACHE_MB = 64  # Memory cap of the prompt prefix KV cache, 0 disables it
+scheduler = None  # ContinuousBatchScheduler, once start_scheduler() was called
+scheduler_loop = None
+
+def configure(precision="fp32", offline=False, fast=False, compile_mode="none", speculative=False,
+              num_speculative=4, prefix_cache_mb=64):
+    global LLM_PRECISION, GPT2_OFFLINE, FAST_KERNELS, COMPILE_MODE, SPECULATIVE, NUM_SPECULATIVE
+    global PREFIX_CACHE_MB, llm_model, draft_model, prefix_cache
+    if precision not in QUANTIZATION_MODES:
+        raise ValueError(f"Precision not in {QUANTIZATION_MODES}")
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Compile mode not in {COMPILE_MODES}")
+    LLM_PRECISION, GPT2_OFFLINE, FAST_KERNELS, COMPILE_MODE = precision, offline, fast, compile_mode
+    SPECULATIVE, NUM_SPECULATIVE, PREFIX_CACHE_MB = speculative, num_speculative, prefix_cache_mb
+    llm_model, draft_model, prefix_cache = None, None, None
+
+# ============================== #
+# ✅ Load Models (ML & LLM)
+# ============================== #
+def load_ml_models():
+    global ml_model, label_encoder
+    if ml_model is None:
+        with profiling.span("load_ml_models"):
+            ml_model = joblib.load(ml_model_path)
+            label_encoder = joblib.load(label_encoder_path)
+    return ml_model, label_encoder
+
+def load_llm_from_tf_checkpoint():
+    # GPT-2 weights from the TensorFlow checkpoint, overwritten by the fine-tuned weights
+    settings, params = download_and_load_gpt2(model_size="124M", models_dir="gpt2", offline=GPT2_OFFLINE)
+    model = GPTModel(BASE_CONFIG)
+    load_weights_into_gpt(model, params)
+
+    checkpoint = torch.load(fine_tuned_path, map_location="cpu")
+    model.load_state_dict(checkpoint["Fine_tuned_model_state_dict"], strict=False)
+    model.eval()
+    return model
+
+def convert_checkpoint(path=merged_checkpoint_path):
+    save_merged_checkpoint(load_llm_from_tf_checkpoint(), BASE_CONFIG, path)
+    print(f"✅ Merged checkpoint written to {path}")
+
+def llm_checkpoint_path(precision=None):
+    # The file load_llm() takes the weights from: the saved quantized checkpoint, else the
+    # merged checkpoint, else the fine-tuned weights on top of the GPT-2 download
+    precision = precision or LLM_PRECISION
+    if precision != "fp32":
+        path = quantized_checkpoint_path.format(precision=precision)
+        if os.path.exists(path):
+            return path
+    if os.path.exists(merged_checkpoint_path):
+        return merged_checkpoint_path
+    return fine_tuned_path
+
+def load_fp32_llm():
+    # The merged checkpoint is memory-mapped and needs neither TensorFlow nor the GPT-2 download
+    if llm_checkpoint_path("fp32") == merged_checkpoint_path:
+        model = load_merged_checkpoint(merged_checkpoint_path, device)
+    else:
+        model = load_llm_from_tf_checkpoint().to(device)
+    # One vocabulary matrix instead of two when the fine-tuned output head still equals the
+    # token embeddings (e.g. fine-tuned with --tie-weights); otherwise the model is unchanged
+    tie_output_head(model)
+    return model
+
+def load_llm():
+    global llm_model, prefix_cache
+    if llm_model is None:
+        with profiling.span("load_llm", precision=LLM_PRECISION):
+            if LLM_PRECISION == "fp32":
+                llm_model = load_fp32_llm()
+            else:
+                # Quantized modes are CPU-only; use the saved checkpoint when there is one
+                path = llm_checkpoint_path()
+                if path == quantized_checkpoint_path.format(precision=LLM_PRECISION):
+                    llm_model = load_quantized_checkpoint(path)
+                else:
+                    llm_model = quantize_gpt(load_fp32_llm().cpu(), LLM_PRECISION)
+            if FAST_KERNELS:
+                set_fused_kernels(llm_model)
+            compile_gpt(llm_model, COMPILE_MODE, compile_cache_dir)
+        # Every prompt starts with the same instruction preamble: its keys/values are computed once
+        if PREFIX_CACHE_MB:
+            prefix_cache = PrefixKVCache(max_bytes=PREFIX_CACHE_MB * 2**20)
+        profiling.attach(llm_model)
+    if SPECULATIVE:
+        load_draft_model(next(llm_model.parameters()).device)
+    return llm_model
+
+def load_draft_model(model_device):
+    # None unless speculative decoding is configured and the draft checkpoint exists.
+    # Greedy outputs are identical with and without it, only the latency changes.
+    # model_device is the GPT's device (not llm_device(), which would call back into load_llm).
+    global draft_model, SPECULATIVE
+    if draft_model is None and SPECULATIVE:
+        if not os.path.exists(draft_model_path):
+            print(f"⚠️ No draft model at {draft_model_path}, decoding without speculation.")
+            SPECULATIVE = False
+            return None
+        with profiling.span("load_draft_model", precision=LLM_PRECISION):
+            model = load_merged_checkpoint(draft_model_path, model_device)
+            if LLM_PRECISION != "fp32":
+                model = quantize_gpt(model.cpu(), LLM_PRECISION)
+            if FAST_KERNELS:
+                set_fused_kernels(model)
+        draft_model = model
+    return draft_model
+
+def enable_profiling(max_events=100_000):
+    # Pipeline spans from now on, and per-module timings once the GPT is (or has been) loaded
+    profiler = profiling.enable(max_events=max_events, sync_cuda=device.type == "cuda")
+    if llm_model is not None:
+        profiler.attach(llm_model)
+    return profiler
+
+def write_quantized_checkpoint(precision):
+    path = quantized_checkpoint_path.format(precision=precision)
+    save_quantized_checkpoint(quantize_gpt(load_fp32_llm().cpu(), precision), BASE_CONFIG, precision, path)
+    print(f"✅ {precision} checkpoint written to {path}")
+
+# ============================== #
+# ✅ Continuous Batching (concurrent requests)
+# ============================== #
+def start_scheduler(max_batch_size=16, max_queue_size=64, queue_timeout=30.0):
+    # From now on every LLM request, from any thread, joins one shared decode batch.
+    # The scheduler runs on its own event loop thread.
+    global scheduler, scheduler_loop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-scheduler", daemon=True).start()
+    new_scheduler = ContinuousBatchScheduler(
+        load_llm(),
+        context_size=BASE_CONFIG["context_length"],
+        max_batch_size=max_batch_size,
+        max_queue_size=max_queue_size,
+        queue_timeout=queue_timeout,
+        max_new_tokens=MAX_NEW_TOKENS,
+        eos_id=EOS_ID,
+        prefix_cache=prefix_cache
+    )
+    asyncio.run_coroutine_threadsafe(new_scheduler.start(), loop).result()
+    scheduler, scheduler_loop = new_scheduler, loop
+    return scheduler
+
+def stop_scheduler():
+    global scheduler, scheduler_loop
+    if scheduler is not None:
+        asyncio.run_coroutine_threadsafe(scheduler.stop(), scheduler_loop).result()
+        scheduler_loop.call_soon_threadsafe(scheduler_loop.stop)
+        scheduler, scheduler_loop = None, None
+
+def scheduled_tokens(prompt):
+    # Blocking iterator over the token ids the scheduler generates for one prompt
+    tokens = queue.Queue()
+
+    async def pump():
+        try:
+            async for token in scheduler.stream(prompt):
+                tokens.put(token)
+        finally:
+            tokens.put(None)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), scheduler_loop)
+    try:
+        while (token := tokens.get()) is not None:
+            yield token
+        future.result()  # Re-raises queue timeouts and failed steps
+    finally:
+        future.cancel()
+
+def scheduled_generate(prompts):
+    async def gather():
+        return await asyncio.gather(*(scheduler.generate(prompt) for prompt in prompts))
+    return asyncio.run_coroutine_threadsafe(gather(), scheduler_loop).result()
+
+# ============================== #
+# ✅ Functions
+# ============================== #
+def compute_updrs_score(responses):
+    return sum(responses.values())
+
+def predict_pd_status(updrs_score):
+    ml_model, label_encoder = load_ml_models()
+    with profiling.span("ml_predict"):
+        input_score = [[updrs_score]]
+        prediction = ml_model.predict(input_score)[0]
+        label = label_encoder.inverse_transform([prediction])[0]
+    return label
+
+def get_llm_response(instruction):
+    input_text = format_input(instruction)
+    tokenizer = get_tokenizer()
+    if scheduler is not None:
+        with profiling.span("tokenize"):
+            prompt = tokenizer.encode(input_text)
+        with profiling.span("generate", scheduled=True):
+            new_tokens = list(scheduled_tokens(prompt))
+        with profiling.span("decode"):
+            output = tokenizer.decode(new_tokens)
+        return clean_llm_output(output)
+
+    model = load_llm()
+    with profiling.span("tokenize"):
+        encoded, _ = tokenizer.encode_to_tensor([input_text], device=llm_device())
+    with torch.no_grad(), profiling.span("generate", prompt_tokens=encoded.shape[1]):
+        token_ids = generate(
+            model=model,
+            idx=encoded,
+            max_new_tokens=MAX_NEW_TOKENS,
+            context_size=BASE_CONFIG["context_length"],
+            eos_id=EOS_ID,
+            draft_model=draft_model,  # Loaded by load_llm() with --speculative
+            num_speculative=NUM_SPECULATIVE,
+            prefix_cache=prefix_cache
+        )
+    with profiling.span("decode"):
+        output = tokenizer.decode(token_ids[0, encoded.shape[1]:].tolist())
+    return clean_llm_output(output)
+
+def clean_llm_output(output):
+    # Only the new tokens are decoded (the prompt is removed by token offset, not by text);
+    # they start with the "### Response:" header
+    output = output.strip()
+    if output.startswith(RESPONSE_HEADER):
+        output = output[len(RESPONSE_HEADER):]
+    return output.strip()
+
+def stream_llm_response(instruction):
+    # Streaming variant of get_llm_response: yields the recommendation text as it is generated.
+    # Only the new tokens are decoded, so the prompt is removed by token offset, not by text.
+    input_text = format_input(instruction)
+    tokenizer = get_tokenizer()
+    if scheduler is not None:
+        with profiling.span("tokenize"):
+            prompt = tokenizer.encode(input_text)
+        token_stream = scheduled_tokens(prompt)
+    else:
+        model = load_llm()
+        with profiling.span("tokenize"):
+            encoded, _ = tokenizer.encode_to_tensor([input_text], device=llm_device())
+        token_stream = generate_stream(
+            model=model,
+            idx=encoded,
+            max_new_tokens=MAX_NEW_TOKENS,
+            context_size=BASE_CONFIG["context_length"],
+            eos_id=EOS_ID,
+            draft_model=draft_model,  # Loaded by load_llm() with --speculative
+            num_speculative=NUM_SPECULATIVE,
+            prefix_cache=prefix_cache
+        )
+
+    pending, started = "", False
+    for text in token_ids_to_text_stream(token_stream, tokenizer):
+        pending += text
+        if not started:
+            # Drop the leading "### Response:" header and the whitespace around it
+            pending = pending.lstrip()
+            if RESPONSE_HEADER.startswith(pending):
+                continue
+            if pending.startswith(RESPONSE_HEADER):
+                pending = pending[len(RESPONSE_HEADER):].lstrip()
+                if not pending:
+                    continue
+            started = True
+        # Hold back trailing whitespace: it is only emitted if more text follows
+        chunk = pending.rstrip()
+        if chunk:
+            yield chunk
+        pending = pending[len(chunk):]
+
+def llm_device():
+    # Quantized models always run on the CPU
+    return next(load_llm().parameters()).device
+
+# ============================== #
+# ✅ Batched Inference (many patients at once)
+# ============================== #
+def predict_pd_status_batch(updrs_scores):
+    # One predict/inverse_transform call for the whole batch instead of one per patient
+    ml_model, label_encoder = load_ml_models()
+    with profiling.span("ml_predict", batch_size=len(updrs_scores)):
+        input_scores = np.asarray(updrs_scores).reshape(-1, 1)
+        predictions = ml_model.predict(input_scores)
+        return label_encoder.inverse_transform(predictions).tolist()
+
+def get_llm_responses(instructions, batch_size=16, model=None):
+    input_texts = [format_input(instruction) for instruction in instructions]
+    tokenizer = get_tokenizer()
+    with profiling.span("tokenize", batch_size=len(input_texts)):
+        prompts = tokenizer.encode_batch(input_texts)
+    if scheduler is not None and model is None:
+        # Share the running decode batch with the other requests instead of a batch of our own
+        with profiling.span("generate", batch_size=len(prompts), scheduled=True):
+            generated = scheduled_generate(prompts)
+        with profiling.span("decode", batch_size=len(prompts)):
+            outputs = tokenizer.decode_batch(generated)
+        return [clean_llm_output(output) for output in outputs]
+
+    outputs = []
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        with profiling.span("generate", batch_size=len(batch)):
+            generated = generate_batch(
+                model=model if model is not None else load_llm(),
+                prompts=batch,
+                max_new_tokens=MAX_NEW_TOKENS,
+                context_size=BASE_CONFIG["context_length"],
+                eos_id=EOS_ID,
+                prefix_cache=prefix_cache if model is None else None  # The cache belongs to llm_model
+            )
+        with profiling.span("decode", batch_size=len(batch)):
+            outputs += tokenizer.decode_batch(generated)
+    return [clean_llm_output(output) for output in outputs]
+
+def run_batch(responses_list, response_table=None, batch_size=16):
+    updrs_scores = [compute_updrs_score(responses) for responses in responses_list]
+    predictions = predict_pd_status_batch(updrs_scores)
+
+    # The recommendation only depends on the score: generate each missing score once
+    recommendations = dict(response_table or {})
+    missing = sorted(set(updrs_scores) - set(recommendations))
+    if missing:
+        generated = get_llm_responses([format_instruction(score) for score in missing], batch_size)
+        recommendations.update(zip(missing, generated))
+
+    return [
+        {"updrs_score": score, "prediction": prediction, "recommendation": recommendations[score]}
+        for score, prediction in zip(updrs_scores, predictions)
+    ]
+
+# ============================== #
+# ✅ Quantization Accuracy Report
+# ============================== #
+def quantization_report(precision, report_path, batch_size=16):
+    # Greedy outputs of the quantized model vs. fp32 over the instruction dataset.
+    # Decoding is deterministic per instruction, so each distinct instruction is generated once
+    # and the results are weighted by how often it occurs in the dataset.
+    with open(dataset_path, "r", encoding="utf-8") as file:
+        dataset = json.load(file)
+    counts = {}
+    for entry in dataset:
+        counts[entry["instruction"]] = counts.get(entry["instruction"], 0) + 1
+    instructions = sorted(counts)
+
+    fp32_model = load_fp32_llm().cpu()
+    start = time.perf_counter()
+    reference = get_llm_responses(instructions, batch_size, model=fp32_model)
+    fp32_seconds = time.perf_counter() - start
+
+    quantized_model = quantize_gpt(fp32_model, precision)
+    start = time.perf_counter()
+    candidate = get_llm_responses(instructions, batch_size, model=quantized_model)
+    quantized_seconds = time.perf_counter() - start
+
+    exact = sum(counts[i] for i, a, b in zip(instructions, reference, candidate) if a == b)
+    token_agreement = 0.0
+    tokenizer = get_tokenizer()
+    for instruction, a, b in zip(instructions, reference, candidate):
+        a_ids, b_ids = tokenizer.encode(a), tokenizer.encode(b)
+        same = sum(x == y for x, y in zip(a_ids, b_ids))
+        token_agreement += counts[instruction] * same / max(len(a_ids), len(b_ids), 1)
+
+    report = {
+        "precision": precision,
+        "examples": len(dataset),
+        "distinct_instructions": len(instructions),
+        "exact_match_rate": exact / len(dataset),
+        "token_agreement": token_agreement / len(dataset),
+        "fp32_seconds": fp32_seconds,
+        "quantized_seconds": quantized_seconds,
+        "mismatches": [
+            {"instruction": i, "fp32": a, precision: b}
+            for i, a, b in zip(instructions, reference, candidate) if a != b
+        ],
+    }
+    with open(report_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"✅ {precision} vs fp32: exact match {report['exact_match_rate']:.2%}, "
+          f"token agreement {report['token_agreement']:.2%}, "
+          f"{fp32_seconds:.1f}s → {quantized_seconds:.1f}s. Report written to {report_path}")
+    return report
+
+# ============================== #
+# ✅ Precomputed Response Table
+# ============================== #
+def response_table_key():
+    # The prompt template with a placeholder for the score, plus the decoding settings
+    prompt_template = format_input(format_instruction("{updrs_score}"))
+    generation_settings = {"max_new_tokens": MAX_NEW_TOKENS, "eos_id": EOS_ID,
+                           "config": BASE_CONFIG, "precision": LLM_PRECISION}
+    if FAST_KERNELS:
+        # The fused kernels round differently, which can change a greedy pick
+        generation_settings["fused_kernels"] = True
+    if COMPILE_MODE != "none":
+        generation_settings["compile_mode"] = COMPILE_MODE  # Generated kernels round differently as well
+    # Keyed on the weights that are actually served, not only on the fine-tuning output
+    return table_key(llm_checkpoint_path(), prompt_template, generation_settings)
+
+def build_updrs_response_table(scores, table_path=response_table_path):
+    return build_response_table(
+        lambda score: get_llm_response(format_instruction(score)),
+        scores,
+        response_table_key(),
+        table_path
+    )
+
+def load_updrs_response_table(table_path=response_table_path):
+    # None when the table is missing or stale for the current checkpoint/prompt/precision
+    return load_response_table(table_path, response_table_key())
+
+def get_recommendation(updrs_score, response_table=None):
+    # Table lookup when available, otherwise fall back to generating with the GPT
+    if response_table is not None and updrs_score in response_table:
+        return response_table[updrs_score]
+    return get_llm_response(format_instruction(updrs_score))
+
+def stream_recommendation(updrs_score, response_table=None):
+    if response_table is not None and updrs_score in response_table:
+        yield response_table[updrs_score]
+    else:
+        yield from stream_llm_response(format_instruction(updrs_score))
+
+def stream_assessment(responses, response_table=None):
+    # Score and ML prediction first, then the recommendation text as it is generated
+    updrs_score = compute_updrs_score(responses)
+    yield {"updrs_score": updrs_score, "prediction": predict_pd_status(updrs_score)}
+    for chunk in stream_recommendation(updrs_score, response_table):
+        yield {"text": chunk}
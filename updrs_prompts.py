@@ -0,0 +1,21 @@
+# Prompt format shared by inference (final code.py) and instruction fine-tuning (finetune_updrs.py).
+# Changing it changes the response-table key, so precomputed tables are rebuilt.
+
+RESPONSE_HEADER = "### Response:"
+
+
+def format_instruction(updrs_score):
+    return f"UPDRS score: {updrs_score}"
+
+
+def format_input(instruction):
+    return (
+        f"Below is an instruction that describes a task. "
+        f"Write a response that appropriately completes the request.\n\n"
+        f"### Instruction:\n{instruction}"
+    )
+
+
+def format_response(output):
+    # What the model is trained to continue the prompt with
+    return f"\n\n{RESPONSE_HEADER}\n{output}"
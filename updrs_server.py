@@ -0,0 +1,242 @@
+import os
+import json
+import signal
+import asyncio
+import traceback
+import argparse
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+import profiling
+import updrs_pipeline as pipeline
+from question_bank import load_question_bank
+from response_table import reachable_scores, table_covers
+
+# Long-lived inference server for the Parkinson's assistant (`final code.py` is its client).
+#
+# The models are loaded once in the parent process, which then binds the listening socket and
+# forks the workers. All workers accept on the same socket and share the parent's weight pages
+# (copy-on-write after fork, and the page cache for the memory-mapped merged checkpoint);
+# inference never writes to the weights, so N workers hold one copy of them.
+# Each worker serves one request at a time: the KV cache lives on the model modules.
+# With --continuous-batching each worker handles requests on threads instead, and all of them
+# share one decode batch through batch_scheduler.ContinuousBatchScheduler.
+#
+# Endpoints (JSON in, JSON out):
+#   GET  /health         -> {"status": "ok", "pid": ...}
+#   GET  /metrics        Prometheus counters of the answering worker (--profile)
+#   GET  /trace          Chrome trace of the answering worker's recent events (--profile)
+#   POST /assess         {"responses": {question_id: answer}} -> score, prediction, recommendation
+#   POST /assess/stream  same input, newline-delimited JSON events as they are produced
+#   POST /batch          {"responses_list": [...], "batch_size": 16} -> {"results": [...]}
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class UPDRSRequestHandler(BaseHTTPRequestHandler):
+    server_version = "UPDRSAssistant/1.0"
+    streaming = False  # Set once a streamed response has started
+
+    def log_message(self, format, *args):
+        print(f"[worker {os.getpid()}] {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json({"status": "ok", "pid": os.getpid()})
+        elif self.path == "/metrics" and profiling.profiler is not None:
+            body = profiling.profiler.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/trace" and profiling.profiler is not None:
+            self._send_json(profiling.profiler.chrome_trace())
+        else:
+            self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        try:
+            payload = self._read_json()
+            if not isinstance(payload, dict):
+                raise ValueError("The request body must be a JSON object")
+            for responses in payload.get("responses_list") or [payload.get("responses", {})]:
+                if not isinstance(responses, dict):
+                    raise ValueError(f"Responses must be a {{question_id: answer}} object, not {responses!r}")
+                # Early-exit questionnaires send partial answers, so only the given ones are checked
+                errors = self.server.question_bank.validate_responses(responses, require_all=False)
+                if errors:
+                    raise ValueError("; ".join(errors))
+            if self.path == "/assess":
+                events = list(pipeline.stream_assessment(payload["responses"], self.server.response_table))
+                result = dict(events[0], recommendation="".join(event["text"] for event in events[1:]))
+                self._send_json(result)
+            elif self.path == "/assess/stream":
+                self._stream_json(pipeline.stream_assessment(payload["responses"], self.server.response_table))
+            elif self.path == "/batch":
+                results = pipeline.run_batch(payload["responses_list"], self.server.response_table,
+                                             payload.get("batch_size", 16))
+                self._send_json({"results": results})
+            else:
+                self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json({"error": f"Bad request: {e!r}"}, status=400)
+        except asyncio.TimeoutError as e:
+            # The scheduler queue stayed full (backpressure): the client should retry later
+            self._send_json({"error": f"Overloaded: {e}"}, status=503)
+        except Exception as e:
+            # Never drop the connection without an answer: log the traceback and report a 500
+            traceback.print_exc()
+            error = {"error": f"Internal server error: {e!r}"}
+            try:
+                if self.streaming:
+                    # The 200 status line is already out: the error is the stream's last event
+                    self.wfile.write((json.dumps(error, default=str) + "\n").encode("utf-8"))
+                else:
+                    self._send_json(error, status=500)
+            except OSError:
+                pass  # The client went away
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_json(self, events):
+        # HTTP/1.0 response without Content-Length: one JSON object per line, flushed as it is
+        # produced, and the end of the stream is the connection closing
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.streaming = True
+        for event in events:
+            self.wfile.write((json.dumps(event, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=2, threads_per_worker=None, response_table=None,
+          scheduler_options=None, profile=False):
+    # Load everything before forking so the workers share it. The GPT is skipped when the
+    # response table answers every reachable score; a lookup miss still loads it lazily.
+    if profile:
+        pipeline.enable_profiling()
+    question_bank = load_question_bank()
+    pipeline.load_ml_models()
+    if table_covers(response_table, reachable_scores(question_bank.questions)):
+        print("✅ The response table covers every UPDRS score, the GPT is not loaded.")
+        scheduler_options = None  # Nothing to batch: no worker threads, no scheduler
+    else:
+        pipeline.load_llm()
+
+    # scheduler_options (max_batch_size, max_queue_size, queue_timeout) enable continuous batching
+    server_class = HTTPServer if scheduler_options is None else ThreadingHTTPServer
+    server = server_class((host, port), UPDRSRequestHandler)
+    server.response_table = response_table
+    server.question_bank = question_bank
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            torch.set_num_threads(threads_per_worker)
+            try:
+                if scheduler_options is not None:
+                    # Threads do not survive fork(): every worker starts its own scheduler
+                    pipeline.start_scheduler(**scheduler_options)
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    print(f"🚀 Parkinson’s assistant server on http://{host}:{port} "
+          f"({workers} workers × {threads_per_worker} threads, pids {children})")
+
+    def shutdown(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parkinson’s assistant inference server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Worker processes sharing the loaded weights")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch threads per worker (default: cores / workers)")
+    parser.add_argument("--continuous-batching", action="store_true",
+                        help="Serve requests concurrently and merge their generation into one decode batch")
+    parser.add_argument("--max-batch-size", type=int, default=16,
+                        help="Max sequences decoded together per worker (--continuous-batching)")
+    parser.add_argument("--max-queue-size", type=int, default=64,
+                        help="Requests waiting for a batch slot before new ones are held back")
+    parser.add_argument("--queue-timeout", type=float, default=30.0,
+                        help="Seconds a request may wait for a batch slot before failing with 503")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record per-module and per-stage timings, served on /metrics and /trace")
+    parser.add_argument("--offline", action="store_true",
+                        help="Never download the GPT-2 checkpoint; fail if it is not in the local cache")
+    parser.add_argument("--precision", choices=pipeline.QUANTIZATION_MODES, default=pipeline.LLM_PRECISION,
+                        help="Run the GPT in fp32, int8 (dynamic quantization) or bf16")
+    parser.add_argument("--fast-kernels", action="store_true",
+                        help="Use the native fused LayerNorm and GELU kernels")
+    parser.add_argument("--compile", choices=pipeline.COMPILE_MODES, default="none",
+                        help="Compile the TransformerBlock norms and feed-forward layers (cached on disk)")
+    parser.add_argument("--speculative", action="store_true",
+                        help=f"Speculative decoding with the distilled draft model ({pipeline.draft_model_path})")
+    parser.add_argument("--num-speculative", type=int, default=pipeline.NUM_SPECULATIVE,
+                        help="Draft tokens proposed per verification pass (--speculative)")
+    parser.add_argument("--prefix-cache-mb", type=int, default=pipeline.PREFIX_CACHE_MB,
+                        help="Memory cap of the cached prompt-prefix keys/values (0 disables the cache)")
+    parser.add_argument("--response-table", default=pipeline.response_table_path,
+                        help="Path of the precomputed recommendation table")
+    parser.add_argument("--no-response-table", action="store_true",
+                        help="Always generate with the GPT instead of looking up the table")
+    args = parser.parse_args()
+
+    pipeline.configure(precision=args.precision, offline=args.offline, fast=args.fast_kernels,
+                       compile_mode=args.compile, speculative=args.speculative,
+                       num_speculative=args.num_speculative, prefix_cache_mb=args.prefix_cache_mb)
+    response_table = None
+    if not args.no_response_table:
+        response_table = pipeline.load_updrs_response_table(args.response_table)
+        if response_table is None:
+            print(f"⚠️ No up-to-date response table at {args.response_table}, the GPT will be used.")
+
+    scheduler_options = None
+    if args.continuous_batching:
+        scheduler_options = dict(max_batch_size=args.max_batch_size, max_queue_size=args.max_queue_size,
+                                 queue_timeout=args.queue_timeout)
+    serve(args.host, args.port, args.workers, args.threads_per_worker, response_table, scheduler_options,
+          args.profile)
+
+
+if __name__ == "__main__":
+    main()